@@ -1,16 +1,94 @@
-from flask import Flask, render_template, render_template_string, request, url_for, session, redirect, flash
+from flask import (Flask, render_template, request, url_for, session, redirect, flash, jsonify, make_response, g,
+                   abort, send_from_directory, stream_template, stream_with_context, Request)
 from flask_sqlalchemy import SQLAlchemy
+from markupsafe import Markup, escape
+from jinja2 import ChoiceLoader, DictLoader, FileSystemBytecodeCache
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
 from flask_mail import Mail, Message
-from werkzeug.security import generate_password_hash, check_password_hash
+from PIL import Image, ImageOps, features
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.http import is_resource_modified
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+import atexit
+import base64
+import bisect
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import mimetypes
 import os
+import posixpath
+import re
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
 import time
+import zlib
+import click
 import requests
 
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
 # ---------------------- Initialize Flask app ----------------------
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 
+# ---------------------- Page Templates ----------------------
+# Pages keep their template source inline in the route; render_page() registers it by name the
+# first time, after which Jinja serves the compiled template from its cache. Compiled bytecode
+# is also written to TEMPLATE_CACHE_DIR so freshly started workers skip compilation
+# (set TEMPLATE_CACHE_DIR to an empty value to disable).
+PAGE_TEMPLATES = {}
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(tempfile.gettempdir(), '263explosion-templates'))
+if TEMPLATE_CACHE_DIR:
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)}
+app.jinja_env.loader = ChoiceLoader([app.jinja_env.loader, DictLoader(PAGE_TEMPLATES)])
+
+
+def render_page(name, source, **context):
+    if name not in PAGE_TEMPLATES:
+        PAGE_TEMPLATES[name] = source
+    return render_template(name, **context)
+
+
+# Long listing pages can be streamed instead: the output goes out in STREAM_CHUNK_SIZE pieces
+# while the template renders, so the head and nav are sent before the listing rows are read.
+STREAM_PAGES = os.environ.get('STREAM_PAGES', 'True') == 'True'
+STREAM_CHUNK_SIZE = 4096
+
+
+def stream_page(name, source, **context):
+    if name not in PAGE_TEMPLATES:
+        PAGE_TEMPLATES[name] = source
+
+    def chunks():
+        pending, size = [], 0
+        for piece in stream_template(name, **context):
+            pending.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(pending)
+                pending, size = [], 0
+        if pending:
+            yield ''.join(pending)
+
+    return app.response_class(stream_with_context(chunks()), mimetype='text/html')
+
+
 # ---------------------- Secret Key (for sessions) ----------------------
 app.secret_key = os.environ.get('SECRET_KEY', 'fallback-dev-key')
 
@@ -42,6 +120,7 @@ mail = Mail(app)
 
 # Create directories
 os.makedirs('static/uploads', exist_ok=True)
+os.makedirs('static/uploads/incoming', exist_ok=True)
 os.makedirs('static/img/sponsors', exist_ok=True)
 
 ALLOWED_EXT = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
@@ -123,18 +202,60 @@ class Listing(db.Model):
     category = db.Column(db.String(100), nullable=False)
     province = db.Column(db.String(100), nullable=False)
     price = db.Column(db.String(50))
+    # Parsed from price by parse_price() for range filters and price sorting
+    price_amount = db.Column(db.Numeric(14, 2))
+    price_currency = db.Column(db.String(3))
     description = db.Column(db.Text)
     phone = db.Column(db.String(20))
     whatsapp = db.Column(db.String(20))
     email = db.Column(db.String(120))
-    # Changed from single photo to multiple photos (comma-separated filenames)
-    photos = db.Column(db.String(1000))  # Store comma-separated filenames
+    # Legacy comma-separated filenames; photos now live in ListingPhoto, this is only read
+    # for listings the photo backfill has not reached yet
+    photos = db.Column(db.String(1000))
     country_code_phone = db.Column(db.String(5), default='+263')
     country_code_whatsapp = db.Column(db.String(5), default='+263')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     # Add view_count for popularity tracking
     view_count = db.Column(db.Integer, default=0)
+    # Time-decayed popularity used by sort=popular, see popularity_score()
+    popularity = db.Column(db.Float, default=lambda: popularity_score(0, datetime.utcnow()))
+
+    listing_photos = db.relationship('ListingPhoto', backref='listing', lazy=True,
+                                     order_by='ListingPhoto.position', cascade='all, delete-orphan')
+
+
+class ListingPhoto(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)  # 0 is the cover photo
+    filename = db.Column(db.String(255), nullable=False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    byte_size = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64))  # sha256 hex
+    thumbnails = db.Column(db.Boolean, nullable=False, default=False)  # PHOTO_SIZES variants written
+    ready = db.Column(db.Boolean, nullable=False, default=True)  # False while the upload awaits processing
+
+    __table_args__ = (db.UniqueConstraint('listing_id', 'position', name='uq_listing_photo_position'),)
+
+
+# One stored upload file, named by its content hash and shared by every ListingPhoto with the same content
+class PhotoBlob(db.Model):
+    content_hash = db.Column(db.String(64), primary_key=True)  # sha256 hex
+    filename = db.Column(db.String(255), nullable=False)  # sharded path under UPLOAD_FOLDER
+    byte_size = db.Column(db.Integer)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Listing counts per province x category, kept up to date by post_listing()/delete_listing().
+# Category '' holds the province total and province '' / category '' the overall total.
+class ListingFacet(db.Model):
+    province = db.Column(db.String(100), primary_key=True)
+    category = db.Column(db.String(100), primary_key=True)
+    listing_count = db.Column(db.Integer, nullable=False, default=0)
+    # Bumped whenever a listing in the facet is posted or deleted; drives the page validators
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class Sponsor(db.Model):
@@ -145,14 +266,34 @@ class Sponsor(db.Model):
     is_active = db.Column(db.Boolean, default=True)
 
 
+# Indexes on the listing table, created by migrate_database(). The trailing id matches the
+# (sort key, id) order used by keyset pagination, so pages are read straight off the index.
+LISTING_INDEXES = {
+    'ix_listing_province_category_created': ('province', 'category', 'created_at', 'id'),
+    'ix_listing_province_created': ('province', 'created_at', 'id'),
+    'ix_listing_created': ('created_at', 'id'),
+    'ix_listing_province_category_popularity': ('province', 'category', 'popularity', 'id'),
+    'ix_listing_province_popularity': ('province', 'popularity', 'id'),
+    'ix_listing_popularity': ('popularity', 'id'),
+    'ix_listing_province_price': ('province', 'price_currency', 'price_amount', 'id'),
+    'ix_listing_price': ('price_currency', 'price_amount', 'id'),
+    'ix_listing_user_id': ('user_id',),
+}
+
+# Indexes no longer used by any query, dropped so they stop costing writes
+RETIRED_LISTING_INDEXES = ['ix_listing_view_count']
+
+
 # Database Migration Function
 def migrate_database():
     """Migrate database schema without losing data"""
-    from sqlalchemy import inspect, text
+    from sqlalchemy import bindparam, inspect, text
 
     inspector = inspect(db.engine)
     columns = [col['name'] for col in inspector.get_columns('listing')]
 
+    # Each step commits on its own: on PostgreSQL DDL is transactional, so rolling back a failed
+    # step must not undo the steps before it
     migrations_applied = []
 
     # Migration 1: Add photos column if it doesn't exist
@@ -163,10 +304,12 @@ def migrate_database():
                 # Add new photos column and migrate data
                 db.session.execute(text('ALTER TABLE listing ADD COLUMN photos VARCHAR(1000)'))
                 db.session.execute(text('UPDATE listing SET photos = photo WHERE photo IS NOT NULL'))
+                db.session.commit()
                 migrations_applied.append("Added photos column and migrated data from photo")
             else:
                 # Just add the new column
                 db.session.execute(text('ALTER TABLE listing ADD COLUMN photos VARCHAR(1000)'))
+                db.session.commit()
                 migrations_applied.append("Added photos column")
         except Exception as e:
             print(f"Migration error (photos): {e}")
@@ -176,6 +319,7 @@ def migrate_database():
     if 'country_code_phone' not in columns:
         try:
             db.session.execute(text('ALTER TABLE listing ADD COLUMN country_code_phone VARCHAR(5) DEFAULT "+263"'))
+            db.session.commit()
             migrations_applied.append("Added country_code_phone column")
         except Exception as e:
             print(f"Migration error (country_code_phone): {e}")
@@ -184,6 +328,7 @@ def migrate_database():
     if 'country_code_whatsapp' not in columns:
         try:
             db.session.execute(text('ALTER TABLE listing ADD COLUMN country_code_whatsapp VARCHAR(5) DEFAULT "+263"'))
+            db.session.commit()
             migrations_applied.append("Added country_code_whatsapp column")
         except Exception as e:
             print(f"Migration error (country_code_whatsapp): {e}")
@@ -193,53 +338,1894 @@ def migrate_database():
     if 'view_count' not in columns:
         try:
             db.session.execute(text('ALTER TABLE listing ADD COLUMN view_count INTEGER DEFAULT 0'))
+            db.session.commit()
             migrations_applied.append("Added view_count column")
         except Exception as e:
             print(f"Migration error (view_count): {e}")
             db.session.rollback()
 
-    if migrations_applied:
+    # Migration 4: Add popularity column and score existing listings
+    if 'popularity' not in columns:
+        try:
+            db.session.execute(text('ALTER TABLE listing ADD COLUMN popularity FLOAT DEFAULT 0'))
+            rebuild_popularity()
+            db.session.commit()
+            migrations_applied.append("Added popularity column")
+        except Exception as e:
+            print(f"Migration error (popularity): {e}")
+            db.session.rollback()
+
+    # Migration 4b: Add numeric price columns parsed from the free-form price
+    if 'price_amount' not in columns:
+        try:
+            db.session.execute(text('ALTER TABLE listing ADD COLUMN price_amount NUMERIC(14, 2)'))
+            db.session.execute(text('ALTER TABLE listing ADD COLUMN price_currency VARCHAR(3)'))
+            backfill_prices()
+            db.session.commit()
+            migrations_applied.append("Added price_amount and price_currency columns")
+        except Exception as e:
+            print(f"Migration error (price_amount): {e}")
+            db.session.rollback()
+
+    # Migration 5: Full-text search index (FTS5 on SQLite, tsvector + GIN on PostgreSQL)
+    migrations_applied.extend(setup_search_index(inspector, columns))
+
+    # Migration 6: Indexes for the province/category filters and the page sorts.
+    # Old rows may have a NULL view_count, which would break the view flush arithmetic.
+    try:
+        fixed = db.session.execute(text('UPDATE listing SET view_count = 0 WHERE view_count IS NULL')).rowcount
         db.session.commit()
+        if fixed:
+            migrations_applied.append(f"Set view_count to 0 on {fixed} listings")
+    except Exception as e:
+        print(f"Migration error (view_count backfill): {e}")
+        db.session.rollback()
+
+    existing_indexes = {ix['name'] for ix in inspector.get_indexes('listing')}
+    for name in RETIRED_LISTING_INDEXES:
+        if name in existing_indexes:
+            try:
+                db.session.execute(text(f'DROP INDEX {name}'))
+                db.session.commit()
+                migrations_applied.append(f"Dropped index {name}")
+            except Exception as e:
+                print(f"Migration error (drop {name}): {e}")
+                db.session.rollback()
+    for name, index_columns in LISTING_INDEXES.items():
+        if name in existing_indexes:
+            continue
+        try:
+            db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON listing ({", ".join(index_columns)})'))
+            db.session.commit()
+            migrations_applied.append(f"Created index {name}")
+        except Exception as e:
+            print(f"Migration error ({name}): {e}")
+            db.session.rollback()
+
+    # Migration 6b: Thumbnail flag on listing photos; existing photos get theirs from the backfill
+    if 'thumbnails' not in [col['name'] for col in inspector.get_columns('listing_photo')]:
+        try:
+            db.session.execute(text('ALTER TABLE listing_photo ADD COLUMN thumbnails BOOLEAN NOT NULL DEFAULT FALSE'))
+            db.session.commit()
+            migrations_applied.append("Added listing_photo.thumbnails column")
+        except Exception as e:
+            print(f"Migration error (listing_photo.thumbnails): {e}")
+            db.session.rollback()
+    if 'ready' not in [col['name'] for col in inspector.get_columns('listing_photo')]:
+        try:
+            db.session.execute(text('ALTER TABLE listing_photo ADD COLUMN ready BOOLEAN NOT NULL DEFAULT TRUE'))
+            db.session.commit()
+            migrations_applied.append("Added listing_photo.ready column")
+        except Exception as e:
+            print(f"Migration error (listing_photo.ready): {e}")
+            db.session.rollback()
+
+    # Migration 7: Build facet counts for listings posted before the table existed
+    if 'updated_at' not in [col['name'] for col in inspector.get_columns('listing_facet')]:
+        try:
+            timestamp_type = 'TIMESTAMP' if db.engine.dialect.name == 'postgresql' else 'DATETIME'
+            db.session.execute(text(f'ALTER TABLE listing_facet ADD COLUMN updated_at {timestamp_type}'))
+            db.session.execute(text('UPDATE listing_facet SET updated_at = :now').bindparams(
+                bindparam('now', type_=db.DateTime)), {'now': datetime.utcnow()})
+            db.session.commit()
+            migrations_applied.append("Added listing_facet.updated_at column")
+        except Exception as e:
+            print(f"Migration error (listing_facet.updated_at): {e}")
+            db.session.rollback()
+    if ListingFacet.query.first() is None and Listing.query.first() is not None:
+        try:
+            rebuild_facet_counts()
+            db.session.commit()
+            migrations_applied.append("Built listing facet counts")
+        except Exception as e:
+            print(f"Migration error (listing_facet): {e}")
+            db.session.rollback()
+
+    # Migration 8: Trigram index for typo-tolerant search
+    migrations_applied.extend(setup_fuzzy_index(inspector))
+
+    if migrations_applied:
         print(f"Database migrations applied: {', '.join(migrations_applied)}")
     else:
         print("No database migrations needed")
 
+    report_listing_indexes()
+
+
+def report_listing_indexes():
+    """Print which of the expected listing indexes exist, returns the missing ones"""
+    from sqlalchemy import inspect
+
+    present = {ix['name'] for ix in inspect(db.engine).get_indexes('listing')}
+    missing = [name for name in LISTING_INDEXES if name not in present]
+    print(f"Listing indexes present: {', '.join(n for n in LISTING_INDEXES if n in present) or 'none'}")
+    if missing:
+        print(f"WARNING: listing indexes missing: {', '.join(missing)}")
+    return missing
+
+
+# ---------------------- Full-text search ----------------------
+# Which search implementation is active: 'fts5' (SQLite), 'tsvector' (PostgreSQL)
+# or 'ilike' when the database supports neither. Set by setup_search_index() from the schema
+# actually present, so a worker that lost the race to create the index still uses it.
+SEARCH_BACKEND = 'ilike'
+
+# Column weights for ranking: a hit in the title counts more than one in the description
+SEARCH_WEIGHTS = {'title': 10.0, 'category': 5.0, 'description': 1.0}
+
+
+# Weighted document for a listing row on PostgreSQL ('simple' config: no stemming, works for local names)
+_TSVECTOR_SQL = (
+    "setweight(to_tsvector('simple', COALESCE(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', COALESCE(category, '')), 'B') || "
+    "setweight(to_tsvector('simple', COALESCE(description, '')), 'C')"
+)
+
+
+def setup_search_index(inspector, columns):
+    """Create and backfill the full-text index for listings, returns the migrations applied"""
+    from sqlalchemy import text
+    global SEARCH_BACKEND
+
+    applied = []
+    dialect = db.engine.dialect.name
+
+    if dialect == 'sqlite':
+        if 'listing_fts' not in inspector.get_table_names():
+            try:
+                db.session.execute(text(
+                    'CREATE VIRTUAL TABLE listing_fts USING fts5(title, category, description)'))
+                db.session.execute(text(
+                    "INSERT INTO listing_fts(rowid, title, category, description) "
+                    "SELECT id, title, category, COALESCE(description, '') FROM listing"))
+                db.session.commit()
+                applied.append("Created listing_fts search index")
+            except Exception as e:
+                print(f"Migration error (listing_fts): {e}")
+                db.session.rollback()
+
+    elif dialect == 'postgresql':
+        try:
+            if 'search_vector' not in columns:
+                db.session.execute(text('ALTER TABLE listing ADD COLUMN search_vector tsvector'))
+                db.session.execute(text(f'UPDATE listing SET search_vector = {_TSVECTOR_SQL}'))
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_listing_search_vector ON listing USING GIN (search_vector)'))
+            db.session.commit()
+            if 'search_vector' not in columns:
+                applied.append("Added search_vector column")
+        except Exception as e:
+            print(f"Migration error (search_vector): {e}")
+            db.session.rollback()
+
+    SEARCH_BACKEND = search_backend_in_schema()
+    return applied
+
+
+def search_backend_in_schema():
+    """The search backend the schema supports as it is now, e.g. after another worker created the index"""
+    from sqlalchemy import inspect
+
+    inspector = inspect(db.engine)
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite' and 'listing_fts' in inspector.get_table_names():
+        return 'fts5'
+    if dialect == 'postgresql' and 'search_vector' in {c['name'] for c in inspector.get_columns('listing')}:
+        return 'tsvector'
+    return 'ilike'
+
+
+def rebuild_search_index():
+    """Refill the full-text and trigram indexes from the listing table (the caller commits)"""
+    from sqlalchemy import text
+
+    if SEARCH_BACKEND == 'fts5':
+        db.session.execute(text('DELETE FROM listing_fts'))
+        db.session.execute(text(
+            "INSERT INTO listing_fts(rowid, title, category, description) "
+            "SELECT id, title, category, COALESCE(description, '') FROM listing"))
+    elif SEARCH_BACKEND == 'tsvector':
+        db.session.execute(text(f'UPDATE listing SET search_vector = {_TSVECTOR_SQL}'))
+
+    if FUZZY_BACKEND == 'trigram_table':
+        rebuild_trigrams()
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the search indexes, e.g. after workers ran without them."""
+    rebuild_search_index()
+    db.session.commit()
+    print(f"Search indexes rebuilt ({SEARCH_BACKEND}, fuzzy: {FUZZY_BACKEND or 'none'})")
+
+
+def search_terms(q):
+    # Only keep word characters so user input can never break the MATCH / tsquery syntax
+    return re.findall(r'\w+', q.lower())
+
+
+def index_listing_search(listing):
+    """Add or refresh a listing in the search index (call after flush, before commit)"""
+    from sqlalchemy import text
+
+    if SEARCH_BACKEND == 'fts5':
+        db.session.execute(text('DELETE FROM listing_fts WHERE rowid = :id'), {'id': listing.id})
+        db.session.execute(
+            text('INSERT INTO listing_fts(rowid, title, category, description) '
+                 'VALUES (:id, :title, :category, :description)'),
+            {'id': listing.id, 'title': listing.title, 'category': listing.category,
+             'description': listing.description or ''})
+    elif SEARCH_BACKEND == 'tsvector':
+        db.session.execute(text(f'UPDATE listing SET search_vector = {_TSVECTOR_SQL} WHERE id = :id'),
+                           {'id': listing.id})
+
+    if FUZZY_BACKEND == 'trigram_table':
+        db.session.execute(text('DELETE FROM listing_trigram WHERE listing_id = :id'), {'id': listing.id})
+        index_listing_trigrams(listing.id, listing.title, listing.category)
+
+
+def unindex_listing_search(listing):
+    """Remove a listing from the search indexes (the PostgreSQL ones go away with the row)"""
+    from sqlalchemy import text
+
+    if SEARCH_BACKEND == 'fts5':
+        db.session.execute(text('DELETE FROM listing_fts WHERE rowid = :id'), {'id': listing.id})
+    if FUZZY_BACKEND == 'trigram_table':
+        db.session.execute(text('DELETE FROM listing_trigram WHERE listing_id = :id'), {'id': listing.id})
+
+
+def search_listings(query, q):
+    """Restrict a Listing query to matches for q.
+
+    Returns (query, rank) where rank is a lower-is-better score expression,
+    or None when there is no ranking available.
+    """
+    from sqlalchemy import text, column, Float, Integer
+
+    terms = search_terms(q)
+    if not terms:
+        return query, None
+
+    if SEARCH_BACKEND == 'fts5':
+        # Prefix match every term so partially typed words still find listings
+        match = ' '.join(f'"{t}"*' for t in terms)
+        weights = ', '.join(str(w) for w in SEARCH_WEIGHTS.values())
+        hits = text(f'SELECT rowid AS listing_id, bm25(listing_fts, {weights}) AS rank '
+                    f'FROM listing_fts WHERE listing_fts MATCH :match') \
+            .bindparams(match=match) \
+            .columns(column('listing_id', Integer), column('rank', Float)) \
+            .subquery('search_hits')
+        query = query.join(hits, Listing.id == hits.c.listing_id)
+        # bm25() is already lower-is-better
+        return query, hits.c.rank
+
+    if SEARCH_BACKEND == 'tsvector':
+        tsquery = db.func.to_tsquery('simple', ' & '.join(f'{t}:*' for t in terms))
+        vector = db.literal_column('listing.search_vector')
+        query = query.filter(vector.op('@@')(tsquery))
+        return query, -db.func.ts_rank(vector, tsquery)
+
+    query = query.filter(
+        db.or_(
+            Listing.title.ilike(f'%{q}%'),
+            Listing.category.ilike(f'%{q}%'),
+            Listing.description.ilike(f'%{q}%')
+        )
+    )
+    return query, None
+
+
+# ---------------------- Typo-tolerant search ----------------------
+# 'pg_trgm' (GIN trigram indexes on PostgreSQL), 'trigram_table' (listing_trigram on SQLite)
+# or None when fuzzy matching is unavailable. Set by setup_fuzzy_index() from the schema actually
+# present, like SEARCH_BACKEND.
+FUZZY_BACKEND = None
+
+# Share of the query's trigrams a listing's title/category must contain to count as a match
+FUZZY_THRESHOLD = float(os.environ.get('FUZZY_THRESHOLD', 0.5))
+
+
+def trigrams(text):
+    """pg_trgm style trigrams: every word lowercased and padded with two spaces in front, one behind"""
+    grams = set()
+    for word in search_terms(text or ''):
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def setup_fuzzy_index(inspector):
+    """Create and backfill the trigram index over listing title and category, returns the migrations applied"""
+    from sqlalchemy import text
+    global FUZZY_BACKEND
+
+    applied = []
+    dialect = db.engine.dialect.name
+
+    if dialect == 'sqlite':
+        if 'listing_trigram' not in inspector.get_table_names():
+            try:
+                db.session.execute(text(
+                    'CREATE TABLE listing_trigram (trigram VARCHAR(3) NOT NULL, listing_id INTEGER NOT NULL, '
+                    'PRIMARY KEY (trigram, listing_id))'))
+                db.session.execute(text('CREATE INDEX ix_listing_trigram_listing ON listing_trigram (listing_id)'))
+                rebuild_trigrams()
+                db.session.commit()
+                applied.append("Created listing_trigram index")
+            except Exception as e:
+                print(f"Migration error (listing_trigram): {e}")
+                db.session.rollback()
+
+    elif dialect == 'postgresql':
+        try:
+            db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_listing_title_trgm ON listing USING GIN (title gin_trgm_ops)'))
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_listing_category_trgm ON listing USING GIN (category gin_trgm_ops)'))
+            db.session.commit()
+        except Exception as e:
+            print(f"Migration error (pg_trgm): {e}")
+            db.session.rollback()
+
+    FUZZY_BACKEND = fuzzy_backend_in_schema()
+    return applied
 
-# Create tables and migrate
-with app.app_context():
-    db.create_all()
-    migrate_database()
-    # Initialize default data only if no users exist
-    if User.query.count() == 0:
-        # Default sponsors - UPDATED with Horizon Vehicles
-        if Sponsor.query.count() == 0:
-            default_sponsors = [
-                {"name": "Hitbay Sanitation", "image": "hitbay.jpg", "url": "https://www.hitbaysanitation.co.zw"},
-                {"name": "Horizon Vehicles", "image": "horizonvehicles.jpg", "url": "https://horizonvehicles.com/country/zimbabwe"}             ]
-            for sponsor_data in default_sponsors:
-                sponsor = Sponsor(**sponsor_data)
-                db.session.add(sponsor)
-
-        # Default admin user
-        if User.query.filter_by(email="admin@263explosion.com").first() is None:
-            admin_user = User(
-                email="admin@263explosion.com",
-                name="Admin",
-                password_hash=generate_password_hash("test123")
-            )
-            db.session.add(admin_user)
-
-        # Default regular user
-        if User.query.filter_by(email="user@263explosion.com").first() is None:
-            regular_user = User(
-                email="user@263explosion.com",
-                name="Zimbo User",
-                password_hash=generate_password_hash("263explosion")
-            )
-            db.session.add(regular_user)
 
+def fuzzy_backend_in_schema():
+    """The fuzzy backend the schema supports as it is now, e.g. after another worker created the index"""
+    from sqlalchemy import inspect, text
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite' and 'listing_trigram' in inspect(db.engine).get_table_names():
+        return 'trigram_table'
+    if dialect == 'postgresql' and db.session.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first():
+        return 'pg_trgm'
+    return None
+
+
+def index_listing_trigrams(listing_id, title, category):
+    from sqlalchemy import text
+
+    grams = trigrams(f'{title} {category}')
+    if grams:
+        db.session.execute(text('INSERT INTO listing_trigram (trigram, listing_id) VALUES (:trigram, :id)'),
+                           [{'trigram': g, 'id': listing_id} for g in grams])
+
+
+def rebuild_trigrams(batch_size=1000):
+    """Refill listing_trigram from the listing table in id batches (the caller commits)"""
+    from sqlalchemy import text
+
+    db.session.execute(text('DELETE FROM listing_trigram'))
+    last_id = 0
+    while True:
+        rows = db.session.query(Listing.id, Listing.title, Listing.category) \
+            .filter(Listing.id > last_id).order_by(Listing.id).limit(batch_size).all()
+        if not rows:
+            break
+        for row in rows:
+            index_listing_trigrams(row.id, row.title, row.category)
+        last_id = rows[-1].id
+
+
+def fuzzy_search_listings(query, q):
+    """Restrict a Listing query to title/category matches for q that tolerate typos.
+
+    Returns (query, rank) like search_listings(); rank is minus the similarity.
+    """
+    from sqlalchemy import text, column, bindparam, Float, Integer
+
+    if FUZZY_BACKEND == 'trigram_table':
+        grams = trigrams(q)
+        if not grams:
+            return query, None
+        needed = max(1, math.ceil(FUZZY_THRESHOLD * len(grams)))
+        hits = text('SELECT listing_id, -COUNT(*) * 1.0 / :total AS rank FROM listing_trigram '
+                    'WHERE trigram IN :grams GROUP BY listing_id HAVING COUNT(*) >= :needed') \
+            .bindparams(bindparam('grams', list(grams), expanding=True), total=len(grams), needed=needed) \
+            .columns(column('listing_id', Integer), column('rank', Float)) \
+            .subquery('fuzzy_hits')
+        return query.join(hits, Listing.id == hits.c.listing_id), hits.c.rank
+
+    if FUZZY_BACKEND == 'pg_trgm':
+        # <% uses this threshold and can be answered from the GIN trigram indexes
+        db.session.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+                           {'threshold': str(FUZZY_THRESHOLD)})
+        term = db.literal(q)
+        query = query.filter(db.or_(term.op('<%')(Listing.title), term.op('<%')(Listing.category)))
+        rank = -db.func.greatest(db.func.word_similarity(term, Listing.title),
+                                 db.func.word_similarity(term, Listing.category))
+        return query, rank
+
+    return query.filter(db.false()), None
+
+
+def find_listings(q, province_filter, sort_by, per_page, stream=False):
+    """One page of search results for q, retried typo-tolerant when nothing matches exactly.
+
+    Returns (listings, next_cursor, fuzzy). Fuzzy results are ranked by similarity
+    unless the popular or a price sort was asked for. With stream=True listings is a
+    ListingStream and next_cursor is None until it has been read.
+    """
+    fuzzy = request.args.get('match') == 'fuzzy' and FUZZY_BACKEND is not None
+    while True:
+        if fuzzy:
+            query, rank = fuzzy_search_listings(Listing.query, q)
+        else:
+            query, rank = search_listings(Listing.query, q)
+        if province_filter:
+            query = query.filter(Listing.province == province_filter)
+        query = filter_by_price(query, sort_by)
+
+        effective_sort = 'relevance' if fuzzy and sort_by in ('newest', 'relevance') else sort_by
+        if stream:
+            results, next_cursor = ListingStream(query, effective_sort, rank, per_page=per_page), None
+        else:
+            results, next_cursor = paginate_listings(query, effective_sort, rank, per_page=per_page)
+        if results or fuzzy or FUZZY_BACKEND is None or request.args.get('cursor'):
+            return results, next_cursor, fuzzy
+        fuzzy = True
+
+
+# ---------------------- Prices ----------------------
+DEFAULT_CURRENCY = 'USD'
+
+# Currency markers people type in the price field, longest first so "US$" wins over "$"
+CURRENCY_MARKERS = [
+    ('US$', 'USD'), ('ZW$', 'ZWL'), ('RTGS', 'ZWL'), ('USD', 'USD'), ('ZWL', 'ZWL'), ('ZWG', 'ZWG'),
+    ('ZIG', 'ZWG'), ('ZAR', 'ZAR'), ('GBP', 'GBP'), ('EUR', 'EUR'), ('BWP', 'BWP'),
+    ('$', 'USD'), ('£', 'GBP'), ('€', 'EUR'), ('R', 'ZAR'), ('P', 'BWP'),
+]
+
+PRICE_SORTS = ('price_asc', 'price_desc')
+MAX_PRICE_AMOUNT = Decimal('999999999999.99')
+
+
+def parse_price(text):
+    """Best-effort (amount, currency) from the free-form price, (None, None) when there is no number"""
+    if not text:
+        return None, None
+    upper = text.upper()
+    match = re.search(r'(\d{1,3}(?:[,\s]\d{3})+|\d+)(\.\d+)?\s*([KM])?(?![A-Z])', upper)
+    if not match:
+        return None, None
+    try:
+        amount = Decimal(re.sub(r'[,\s]', '', match.group(1)) + (match.group(2) or ''))
+    except InvalidOperation:
+        return None, None
+    amount *= {'K': 1000, 'M': 1000000}.get(match.group(3), 1)
+    if amount > MAX_PRICE_AMOUNT:
+        return None, None
+
+    currency = DEFAULT_CURRENCY
+    for marker, code in CURRENCY_MARKERS:
+        if re.search(rf'(?<![A-Z]){re.escape(marker)}(?![A-Z])', upper):
+            currency = code
+            break
+    return amount.quantize(Decimal('0.01')), currency
+
+
+def backfill_prices(batch_size=1000):
+    """Parse price_amount/price_currency for listings that have a price but no amount (the caller commits)"""
+    from sqlalchemy import text, bindparam
+
+    update = text('UPDATE listing SET price_amount = :amount, price_currency = :currency WHERE id = :id') \
+        .bindparams(bindparam('amount', type_=Listing.price_amount.type))
+    last_id = 0
+    while True:
+        rows = db.session.query(Listing.id, Listing.price) \
+            .filter(Listing.id > last_id, Listing.price.isnot(None), Listing.price_amount.is_(None)) \
+            .order_by(Listing.id).limit(batch_size).all()
+        if not rows:
+            break
+        parsed = [(row.id,) + parse_price(row.price) for row in rows]
+        params = [{'id': i, 'amount': amount, 'currency': currency} for i, amount, currency in parsed if amount is not None]
+        if params:
+            db.session.execute(update, params)
+        last_id = rows[-1].id
+
+
+def filter_by_price(query, sort_by):
+    """Apply ?min_price= / ?max_price= (in ?currency=, default USD); price sorts only see priced listings"""
+    min_price = request.args.get('min_price', type=float)
+    max_price = request.args.get('max_price', type=float)
+    if min_price is None and max_price is None and sort_by not in PRICE_SORTS and 'currency' not in request.args:
+        return query
+
+    query = query.filter(Listing.price_currency == request.args.get('currency', DEFAULT_CURRENCY).upper()[:3])
+    if min_price is not None:
+        query = query.filter(Listing.price_amount >= min_price)
+    if max_price is not None:
+        query = query.filter(Listing.price_amount <= max_price)
+    return query
+
+
+# ---------------------- Keyset pagination ----------------------
+PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+def listing_sort_keys(sort_by, rank=None):
+    """Return (name, [(expression, descending), ...]) for a sort option, always ending on Listing.id"""
+    if sort_by == 'relevance' and rank is not None:
+        return 'relevance', [(rank, False), (Listing.id, True)]
+    if sort_by == 'popular':
+        return 'popular', [(Listing.popularity, True), (Listing.id, True)]
+    if sort_by == 'price_asc':
+        return 'price_asc', [(Listing.price_amount, False), (Listing.id, False)]
+    if sort_by == 'price_desc':
+        return 'price_desc', [(Listing.price_amount, True), (Listing.id, True)]
+    return 'newest', [(Listing.created_at, True), (Listing.id, True)]
+
+
+def encode_cursor(sort_name, values):
+    payload = [sort_name] + [v.isoformat() if isinstance(v, datetime) else str(v) if isinstance(v, Decimal) else v
+                             for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort_name, size):
+    # A bad or stale cursor (e.g. the sort was changed) just restarts from the first page
+    if not cursor:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if payload[0] != sort_name or len(payload) != size + 1:
+            return None
+        values = payload[1:]
+        if sort_name == 'newest':
+            values[0] = datetime.fromisoformat(values[0])
+        elif sort_name in PRICE_SORTS:
+            values[0] = Decimal(values[0])
+        return values
+    except Exception:
+        return None
+
+
+def keyset_after(keys, values):
+    # (a, b) after (x, y) in the page order: a beyond x, or a == x and b beyond y
+    (expr, desc), rest = keys[0], keys[1:]
+    beyond = expr < values[0] if desc else expr > values[0]
+    if not rest:
+        return beyond
+    return db.or_(beyond, db.and_(expr == values[0], keyset_after(rest, values[1:])))
+
+
+def page_size(default=PAGE_SIZE):
+    return max(1, min(request.args.get('per_page', default, type=int), MAX_PAGE_SIZE))
+
+
+def keyset_page_query(query, sort_by, rank=None):
+    """Order a Listing query for sort_by and start it after the ?cursor= request arg.
+
+    Returns (query, sort_name); each row is the listing followed by its sort key values.
+    """
+    sort_name, keys = listing_sort_keys(sort_by, rank)
+    values = decode_cursor(request.args.get('cursor'), sort_name, len(keys))
+    if values:
+        query = query.filter(keyset_after(keys, values))
+
+    query = query.order_by(*[expr.desc() if desc else expr.asc() for expr, desc in keys])
+    return query.add_columns(*[expr for expr, _ in keys]), sort_name
+
+
+def paginate_listings(query, sort_by, rank=None, per_page=PAGE_SIZE):
+    """Fetch one page of a Listing query using the ?cursor= request arg.
+
+    Returns (listings, next_cursor); next_cursor is None on the last page.
+    """
+    query, sort_name = keyset_page_query(query, sort_by, rank)
+    rows = query.limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(sort_name, list(rows[-1][1:]))
+    return [row[0] for row in rows], next_cursor
+
+
+STREAM_BATCH_SIZE = 24
+
+
+class ListingStream:
+    """One page of a Listing query read lazily from a server-side cursor, for stream_page().
+
+    Iterating yields the listings in batches of STREAM_BATCH_SIZE, filling covers in per
+    batch; next_cursor is known once the page has been read to the end.
+    """
+
+    def __init__(self, query, sort_by, rank=None, per_page=PAGE_SIZE):
+        query, self.sort_name = keyset_page_query(query, sort_by, rank)
+        self.rows = iter(query.limit(per_page + 1).yield_per(STREAM_BATCH_SIZE))
+        self.per_page = per_page
+        self.covers = {}
+        self.next_cursor = None
+        # Peek at the first row so an empty page is known before anything is rendered
+        self.first = next(self.rows, None)
+
+    def __bool__(self):
+        return self.first is not None
+
+    def __iter__(self):
+        if self.first is None:
+            return
+        rows = itertools.chain([self.first], self.rows)
+        self.first = None
+        remaining, last = self.per_page, None
+        while remaining:
+            batch = list(itertools.islice(rows, min(STREAM_BATCH_SIZE, remaining)))
+            if not batch:
+                return
+            remaining -= len(batch)
+            last = batch[-1]
+            self.covers.update(cover_photos([row[0] for row in batch]))
+            yield from (row[0] for row in batch)
+        if next(rows, None) is not None:
+            self.next_cursor = encode_cursor(self.sort_name, list(last[1:]))
+
+
+class NextPageURL:
+    """page_url() of a ListingStream's next page, worked out when the template gets to it"""
+
+    def __init__(self, page, **overrides):
+        self.page = page
+        self.overrides = overrides
+
+    def __bool__(self):
+        return self.page.next_cursor is not None
+
+    def __str__(self):
+        return page_url(self.page.next_cursor, **self.overrides)
+
+
+# Query args that change what a listing page shows, the only ones carried over into its page links
+PAGE_ARGS = {'q', 'province', 'sort', 'cursor', 'per_page', 'match', 'min_price', 'max_price', 'currency'}
+
+
+def page_url(cursor, **overrides):
+    """URL of the current page with a different cursor (None for the first page) and query args"""
+    view_args = request.view_args or {}
+    # Anything else (tracking params, url_for's own _external/_anchor, names clashing with the
+    # view args) is left out of the links
+    args = {k: v for k, v in request.args.items() if k in PAGE_ARGS and k not in view_args}
+    args.update(overrides, cursor=cursor)
+    args = {k: v for k, v in args.items() if v is not None}
+    return url_for(request.endpoint, **view_args, **args)
+
+
+def listing_page_links(results, next_cursor, fuzzy):
+    """covers, next_url and first_url template arguments for a page of listings"""
+    match = 'fuzzy' if fuzzy else None
+    if isinstance(results, ListingStream):
+        covers, next_url = results.covers, NextPageURL(results, match=match)
+    else:
+        covers = cover_photos(results)
+        next_url = page_url(next_cursor, match=match) if next_cursor else None
+    return {'covers': covers, 'next_url': next_url,
+            'first_url': page_url(None) if request.args.get('cursor') else None}
+
+
+# ---------------------- Facet counts ----------------------
+def adjust_facet_counts(province, category, delta):
+    """Add delta to the counts a listing contributes to, inside the caller's transaction"""
+    from sqlalchemy import bindparam, text
+
+    statement = text(
+        'INSERT INTO listing_facet (province, category, listing_count, updated_at) '
+        'VALUES (:province, :category, :delta, :now) '
+        'ON CONFLICT (province, category) DO UPDATE '
+        'SET listing_count = listing_facet.listing_count + excluded.listing_count, updated_at = excluded.updated_at'
+    ).bindparams(bindparam('now', type_=db.DateTime))
+    now = datetime.utcnow()
+    for facet_province, facet_category in ((province, category), (province, ''), ('', '')):
+        db.session.execute(statement, {'province': facet_province, 'category': facet_category,
+                                       'delta': delta, 'now': now})
+
+
+def rebuild_facet_counts():
+    """Recount every facet from the listing table (the caller commits)"""
+    from sqlalchemy import bindparam, text
+
+    now = {'now': datetime.utcnow()}
+    stamp = bindparam('now', type_=db.DateTime)
+    db.session.execute(text('DELETE FROM listing_facet'))
+    db.session.execute(text(
+        'INSERT INTO listing_facet (province, category, listing_count, updated_at) '
+        'SELECT province, category, COUNT(*), :now FROM listing GROUP BY province, category').bindparams(stamp), now)
+    db.session.execute(text(
+        "INSERT INTO listing_facet (province, category, listing_count, updated_at) "
+        "SELECT province, '', COUNT(*), :now FROM listing GROUP BY province").bindparams(stamp), now)
+    db.session.execute(text(
+        "INSERT INTO listing_facet (province, category, listing_count, updated_at) "
+        "SELECT '', '', COUNT(*), :now FROM listing").bindparams(stamp), now)
+
+
+def province_counts():
+    return {f.province: f.listing_count
+            for f in ListingFacet.query.filter(ListingFacet.category == '', ListingFacet.province != '')}
+
+
+def province_category_counts(province):
+    facets = ListingFacet.query.filter(ListingFacet.province == province, ListingFacet.category != '',
+                                       ListingFacet.listing_count > 0).order_by(ListingFacet.category)
+    return [(f.category, f.listing_count) for f in facets]
+
+
+def total_listing_count(province=''):
+    facet = db.session.get(ListingFacet, (province, ''))
+    return facet.listing_count if facet else 0
+
+
+@app.cli.command('rebuild-facets')
+def rebuild_facets_command():
+    """Recount listings per province and category."""
+    rebuild_facet_counts()
+    db.session.commit()
+    print(f"Facet counts rebuilt: {total_listing_count()} listings")
+
+
+# ---------------------- Popularity ----------------------
+# Views decay with a half-life of POPULARITY_HALF_LIFE_DAYS. Rather than views * exp(-age / tau),
+# which changes for every row as time passes, we store its logarithm shifted by now / tau:
+#   ln(1 + views) + created_at / tau
+# That ranks listings identically, but only changes when a listing's views change, so the
+# view flusher keeps it current incrementally and sort=popular is a plain index scan.
+POPULARITY_HALF_LIFE_DAYS = float(os.environ.get('POPULARITY_HALF_LIFE_DAYS', 7))
+POPULARITY_EPOCH = datetime(2024, 1, 1)
+
+
+def popularity_score(view_count, created_at):
+    tau = POPULARITY_HALF_LIFE_DAYS * 86400 / math.log(2)
+    age = ((created_at or POPULARITY_EPOCH) - POPULARITY_EPOCH).total_seconds()
+    return math.log1p(view_count or 0) + age / tau
+
+
+def refresh_popularity(listing_ids):
+    """Recompute the score of the given listings (the caller commits)"""
+    from sqlalchemy import text
+
+    rows = db.session.query(Listing.id, Listing.view_count, Listing.created_at) \
+        .filter(Listing.id.in_(listing_ids)).all()
+    if rows:
+        db.session.execute(text('UPDATE listing SET popularity = :score WHERE id = :id'),
+                           [{'id': r.id, 'score': popularity_score(r.view_count, r.created_at)} for r in rows])
+
+
+def rebuild_popularity(batch_size=1000):
+    """Rescore every listing in id batches, e.g. after changing the half-life (the caller commits)"""
+    last_id = 0
+    while True:
+        ids = [r.id for r in db.session.query(Listing.id).filter(Listing.id > last_id)
+               .order_by(Listing.id).limit(batch_size)]
+        if not ids:
+            break
+        refresh_popularity(ids)
+        last_id = ids[-1]
+
+
+@app.cli.command('rebuild-popularity')
+def rebuild_popularity_command():
+    """Rescore every listing for sort=popular."""
+    rebuild_popularity()
+    db.session.commit()
+    print("Popularity scores rebuilt")
+
+
+# ---------------------- View counting ----------------------
+# Listing views are counted in memory per worker and written to listing.view_count in one
+# batched UPDATE every VIEW_FLUSH_INTERVAL seconds or VIEW_FLUSH_COUNT views, and on shutdown.
+# Each flush also refreshes the popularity score of the listings it touched.
+VIEW_FLUSH_INTERVAL = int(os.environ.get('VIEW_FLUSH_INTERVAL', 30))
+VIEW_FLUSH_COUNT = int(os.environ.get('VIEW_FLUSH_COUNT', 100))
+
+VIEW_BUFFER = {"counts": {}, "pending": 0, "flusher_pid": None}
+_view_lock = threading.Lock()
+
+
+def record_view(listing_id):
+    with _view_lock:
+        counts = VIEW_BUFFER["counts"]
+        counts[listing_id] = counts.get(listing_id, 0) + 1
+        VIEW_BUFFER["pending"] += 1
+        full = VIEW_BUFFER["pending"] >= VIEW_FLUSH_COUNT
+
+    start_view_flusher()
+    if full:
+        flush_views()
+
+
+def pending_views(listing_id):
+    with _view_lock:
+        return VIEW_BUFFER["counts"].get(listing_id, 0)
+
+
+def discard_views(listing_id):
+    with _view_lock:
+        VIEW_BUFFER["pending"] -= VIEW_BUFFER["counts"].pop(listing_id, 0)
+
+
+def flush_views():
+    """Write buffered views to the database, returns the number of views written"""
+    from sqlalchemy import text
+
+    with _view_lock:
+        counts = VIEW_BUFFER["counts"]
+        if not counts:
+            return 0
+        VIEW_BUFFER["counts"] = {}
+        VIEW_BUFFER["pending"] = 0
+
+    try:
+        # Own app context (and so own session) so a flush never commits a request's work
+        with app.app_context():
+            db.session.execute(text('UPDATE listing SET view_count = view_count + :views WHERE id = :id'),
+                               [{'id': listing_id, 'views': views} for listing_id, views in counts.items()])
+            refresh_popularity(list(counts))
+            db.session.commit()
+    except Exception as e:
+        print(f"Error flushing view counts: {e}")
+        # Put the views back so the next flush retries them
+        with _view_lock:
+            for listing_id, views in counts.items():
+                VIEW_BUFFER["counts"][listing_id] = VIEW_BUFFER["counts"].get(listing_id, 0) + views
+                VIEW_BUFFER["pending"] += views
+        return 0
+    return sum(counts.values())
+
+
+def _view_flusher():
+    while True:
+        time.sleep(VIEW_FLUSH_INTERVAL)
+        flush_views()
+
+
+def start_view_flusher():
+    # One flusher thread per worker process; gunicorn forks workers after import
+    if VIEW_BUFFER["flusher_pid"] == os.getpid():
+        return
+    with _view_lock:
+        if VIEW_BUFFER["flusher_pid"] == os.getpid():
+            return
+        VIEW_BUFFER["flusher_pid"] = os.getpid()
+    threading.Thread(target=_view_flusher, name='view-flusher', daemon=True).start()
+
+
+atexit.register(flush_views)
+
+
+# ---------------------- Listing photos ----------------------
+PHOTO_BACKFILL_BATCH = 200
+
+
+def read_image_size(path):
+    """(width, height) from a PNG, GIF, JPEG or WebP header, (None, None) if it can't be read"""
+    import struct
+
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(32)
+            if head.startswith(b'\x89PNG\r\n\x1a\n'):
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+                if head[12:16] == b'VP8X':
+                    return (int.from_bytes(head[24:27], 'little') + 1,
+                            int.from_bytes(f.read(3), 'little') + 1)
+                if head[12:16] == b'VP8 ':
+                    w, h = struct.unpack('<HH', head[26:30])
+                    return w & 0x3fff, h & 0x3fff
+                if head[12:16] == b'VP8L':
+                    bits = int.from_bytes(head[21:25], 'little')
+                    return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+            if head[:2] == b'\xff\xd8':
+                # Walk the JPEG segments to the first start-of-frame marker
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xff:
+                        break
+                    if marker[1] in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf):
+                        h, w = struct.unpack('>xxxHH', f.read(7))  # segment length, precision, height, width
+                        return w, h
+                    f.seek(struct.unpack('>H', f.read(2))[0] - 2, 1)
+    except (OSError, struct.error):
+        pass
+    return None, None
+
+
+def photo_metadata(filename):
+    """Size, dimensions and sha256 of an uploaded photo, all None if the file is missing"""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    try:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        byte_size = os.path.getsize(path)
+    except OSError:
+        return {'width': None, 'height': None, 'byte_size': None, 'content_hash': None}
+    width, height = read_image_size(path)
+    return {'width': width, 'height': height, 'byte_size': byte_size, 'content_hash': digest.hexdigest()}
+
+
+# Uploads also get a card- and a detail-size thumbnail (width in px), each as JPEG and WebP,
+# written next to the original as <name>.<size>.<ext>
+PHOTO_SIZES = {'card': 480, 'detail': 1280}
+PHOTO_FORMATS = {'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+                 'webp': ('WEBP', {'quality': 80, 'method': 4})}
+# How wide the photo is drawn, for the browser to pick from srcset
+PHOTO_DISPLAY_SIZES = {'card': '(min-width: 992px) 33vw, (min-width: 768px) 50vw, 100vw',
+                       'detail': '(min-width: 800px) 800px, 100vw'}
+
+PhotoRef = namedtuple('PhotoRef', 'filename width thumbnails ready')
+
+
+def photo_variant(filename, size, ext):
+    return f'{os.path.splitext(filename)[0]}.{size}.{ext}'
+
+
+def photo_files(filename):
+    """The upload and every thumbnail that may have been written for it"""
+    return [filename] + [photo_variant(filename, size, ext) for size in PHOTO_SIZES for ext in PHOTO_FORMATS]
+
+
+def write_photo_thumbnails(image, filename):
+    """Write the PHOTO_SIZES thumbnails of an upright, decoded photo"""
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, 'white')
+        flat.paste(image, mask=image.getchannel('A'))
+        image = flat
+    else:
+        image = image.convert('RGB')
+
+    folder = app.config['UPLOAD_FOLDER']
+    for size, width in PHOTO_SIZES.items():
+        thumbnail = image.copy()
+        thumbnail.thumbnail((width, width * 10))
+        for ext, (image_format, options) in PHOTO_FORMATS.items():
+            thumbnail.save(os.path.join(folder, photo_variant(filename, size, ext)), image_format, **options)
+
+
+def make_photo_thumbnails(filename):
+    """Write the thumbnails of a stored upload, turned upright by its EXIF orientation.
+
+    Returns the upright (width, height), or None if the file can't be decoded.
+    """
+    try:
+        with Image.open(os.path.join(app.config['UPLOAD_FOLDER'], filename)) as source:
+            image = ImageOps.exif_transpose(source)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    write_photo_thumbnails(image, filename)
+    return image.size
+
+
+def thumbnail_photo(photo):
+    size = make_photo_thumbnails(photo.filename)
+    if size:
+        photo.width, photo.height = size
+        photo.thumbnails = True
+
+
+def add_listing_photos(listing, filenames):
+    for position, filename in enumerate(filenames):
+        photo = ListingPhoto(position=position, filename=filename, **photo_metadata(filename))
+        thumbnail_photo(photo)
+        listing.listing_photos.append(photo)
+
+
+def listing_photo_filenames(listing):
+    if listing.listing_photos:
+        return [p.filename for p in listing.listing_photos]
+    return [f for f in (listing.photos or '').split(',') if f]
+
+
+def listing_photo_refs(listing):
+    if listing.listing_photos:
+        return [PhotoRef(p.filename, p.width, p.thumbnails, p.ready) for p in listing.listing_photos]
+    return [PhotoRef(f, None, False, True) for f in (listing.photos or '').split(',') if f]
+
+
+def cover_photos(listings):
+    """{listing_id: PhotoRef of the cover} for a page of listings in one query"""
+    ids = [l.id for l in listings]
+    if not ids:
+        return {}
+    covers = {row[0]: PhotoRef(*row[1:]) for row in
+              db.session.query(ListingPhoto.listing_id, ListingPhoto.filename, ListingPhoto.width,
+                               ListingPhoto.thumbnails, ListingPhoto.ready)
+              .filter(ListingPhoto.listing_id.in_(ids), ListingPhoto.position == 0)}
+    for l in listings:
+        if l.id not in covers and l.photos:
+            covers[l.id] = PhotoRef(l.photos.split(',')[0], None, False, True)
+    return covers
+
+
+@app.template_global()
+def photo_picture(photo, size, **attrs):
+    """<picture> for an uploaded photo, offering its WebP and JPEG thumbnails by srcset.
+
+    attrs become attributes of the <img> (class_ for class); it loads lazily unless loading is given.
+    A photo still being processed is drawn as a placeholder box with the same class and style.
+    """
+    if not photo.ready:
+        classes = f'{attrs.get("class_", "")} bg-secondary-subtle text-secondary d-flex align-items-center justify-content-center'
+        return Markup(f'<div class="{escape(classes)}" style="{escape(attrs.get("style", ""))}" role="img" '
+                      f'aria-label="{escape(attrs.get("alt", ""))}">Processing photo…</div>')
+
+    attrs.setdefault('loading', 'lazy')
+    attributes = ' '.join(f'{escape(name.rstrip("_"))}="{escape(value)}"' for name, value in attrs.items())
+    if not photo.thumbnails:
+        return Markup(f'<img src="{escape(url_for("static", filename="uploads/" + photo.filename))}" {attributes}>')
+
+    # A photo no wider than the card thumbnail only has that one useful width
+    widths = {name: min(width, photo.width or width) for name, width in PHOTO_SIZES.items()}
+    if widths['detail'] <= widths['card']:
+        del widths['detail']
+
+    def srcset(ext):
+        return escape(', '.join(f'{url_for("static", filename="uploads/" + photo_variant(photo.filename, name, ext))} {width}w'
+                                for name, width in widths.items()))
+
+    fallback = escape(url_for('static', filename='uploads/' + photo_variant(photo.filename, size, 'jpg')))
+    sizes = PHOTO_DISPLAY_SIZES[size]
+    return Markup(f'<picture><source type="image/webp" srcset="{srcset("webp")}" sizes="{sizes}">'
+                  f'<img src="{fallback}" srcset="{srcset("jpg")}" sizes="{sizes}" decoding="async" {attributes}></picture>')
+
+
+def backfill_listing_photos(batch_size=PHOTO_BACKFILL_BATCH):
+    """Move photos strings into ListingPhoto rows one committed batch at a time, returns listings moved"""
+    moved = 0
+    last_id = 0
+    while True:
+        listings = Listing.query.filter(Listing.id > last_id, Listing.photos.isnot(None), Listing.photos != '',
+                                        ~Listing.listing_photos.any()) \
+            .order_by(Listing.id).limit(batch_size).all()
+        if not listings:
+            return moved
+        for listing in listings:
+            add_listing_photos(listing, [f for f in listing.photos.split(',') if f])
+        try:
+            db.session.commit()
+            moved += len(listings)
+        except Exception as e:
+            # Another worker backfilled the same listings; skip past them
+            print(f"Photo backfill batch skipped: {e}")
+            db.session.rollback()
+        last_id = listings[-1].id
+
+
+def backfill_thumbnails(batch_size=PHOTO_BACKFILL_BATCH):
+    """Write missing thumbnails one committed batch at a time, returns photos done"""
+    done = 0
+    last_id = 0
+    while True:
+        photos = ListingPhoto.query.filter(ListingPhoto.id > last_id, ListingPhoto.thumbnails.is_(False),
+                                           ListingPhoto.ready.is_(True)) \
+            .order_by(ListingPhoto.id).limit(batch_size).all()
+        if not photos:
+            return done
+        for photo in photos:
+            thumbnail_photo(photo)
+            done += photo.thumbnails
         db.session.commit()
-        print("Default data initialized")
+        last_id = photos[-1].id
+
+
+def _photo_backfill():
+    try:
+        with app.app_context():
+            moved = backfill_listing_photos()
+            if moved:
+                print(f"Photo backfill: moved photos of {moved} listings")
+            stored = migrate_photo_storage()
+            if stored:
+                print(f"Photo backfill: moved {stored} photos into the content-addressed store")
+            thumbnailed = backfill_thumbnails()
+            if thumbnailed:
+                print(f"Photo backfill: wrote thumbnails for {thumbnailed} photos")
+            requeued = requeue_staged_photos()
+            if requeued:
+                print(f"Photo backfill: requeued photos of {requeued} listings")
+            report_upload_sweep(*sweep_uploads(max_files=UPLOAD_SWEEP_MAX_FILES))
+    except Exception as e:
+        print(f"Error backfilling photos: {e}")
+
+
+@app.cli.command('backfill-photos')
+def backfill_photos_command():
+    """Move legacy photos into the listing_photo table and the content-addressed store, write missing thumbnails."""
+    print(f"Moved photos of {backfill_listing_photos()} listings")
+    print(f"Moved {migrate_photo_storage()} photos into the content-addressed store")
+    print(f"Wrote thumbnails for {backfill_thumbnails()} photos")
+
+
+# ---------------------- Upload storage ----------------------
+# Processed photos are stored once per content: <aa>/<bb>/<sha256>.<ext> under UPLOAD_FOLDER, with
+# their thumbnails beside them. photo_blob counts the ListingPhoto rows using each file, which is
+# deleted with its thumbnails when the last of them goes. Photos stored flat by older versions are
+# moved in by migrate_photo_storage().
+UPLOAD_SHARD_DEPTH = 2
+
+
+def stored_photo_name(content_hash, ext):
+    shards = [content_hash[2 * i:2 * i + 2] for i in range(UPLOAD_SHARD_DEPTH)]
+    return '/'.join(shards + [f'{content_hash}.{ext}'])
+
+
+def is_stored_photo_name(filename):
+    return filename.count('/') == UPLOAD_SHARD_DEPTH
+
+
+def write_upload_file(filename, data=None, source=None):
+    """Create an upload file from bytes or as a hard link to (else copy of) source, atomically"""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    if data is not None:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+    else:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def remove_photo_files(filename):
+    for name in photo_files(filename):
+        try:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], name))
+        except FileNotFoundError:
+            pass
+
+
+def acquire_blob(content_hash, filename, byte_size):
+    """Count one more reference to a stored file inside the caller's transaction, returns the new count.
+
+    A count of 1 means no photo used the file, so whatever is on disk may be mid-removal by
+    remove_blob_files() and the caller must write the files again.
+    """
+    from sqlalchemy import text
+
+    return db.session.execute(
+        text('INSERT INTO photo_blob (content_hash, filename, byte_size, ref_count) '
+             'VALUES (:content_hash, :filename, :byte_size, 1) '
+             'ON CONFLICT (content_hash) DO UPDATE SET ref_count = photo_blob.ref_count + 1 '
+             'RETURNING ref_count'),
+        {'content_hash': content_hash, 'filename': filename, 'byte_size': byte_size}).scalar()
+
+
+def release_blob(content_hash):
+    """Drop one reference inside the caller's transaction.
+
+    Returns the file's name when that was the last reference; delete it after committing.
+    """
+    from sqlalchemy import text
+
+    db.session.execute(text('UPDATE photo_blob SET ref_count = ref_count - 1 WHERE content_hash = :content_hash'),
+                       {'content_hash': content_hash})
+    blob = db.session.get(PhotoBlob, content_hash, populate_existing=True)
+    if blob is None or blob.ref_count > 0:
+        return None
+    db.session.delete(blob)
+    return blob.filename
+
+
+def remove_blob_files(content_hash, paths):
+    """Remove the files of stored content no photo_blob row counts, in a transaction of its own.
+
+    A placeholder row is held while the files go, so an acquire_blob() for the same content waits
+    for the removal and then starts a new count. Returns False, removing nothing, if a photo has
+    taken the content up again since it was released.
+    """
+    from sqlalchemy import text
+
+    try:
+        claimed = db.session.execute(
+            text("INSERT INTO photo_blob (content_hash, filename, byte_size, ref_count) "
+                 "VALUES (:content_hash, '', 0, 0) ON CONFLICT (content_hash) DO NOTHING"),
+            {'content_hash': content_hash}).rowcount
+        if claimed:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            db.session.execute(text('DELETE FROM photo_blob WHERE content_hash = :content_hash AND ref_count = 0'),
+                               {'content_hash': content_hash})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return bool(claimed)
+
+
+def remove_unused_photo(filename):
+    """Remove a photo file and its thumbnails once no listing uses them (commits the session)"""
+    if is_stored_photo_name(filename):
+        remove_blob_files(os.path.basename(filename).split('.')[0],
+                          [os.path.join(app.config['UPLOAD_FOLDER'], name) for name in photo_files(filename)])
+    else:
+        remove_photo_files(filename)
+
+
+def release_listing_photos(listing):
+    """Release the files of a listing being deleted; returns the upload names (staged uploads
+    included) to remove after committing"""
+    if not listing.listing_photos:
+        return listing_photo_filenames(listing)
+    unused = []
+    for photo in listing.listing_photos:
+        if not photo.ready:
+            staged = os.path.join(PHOTO_STAGING_FOLDER, photo.filename)
+            unused.append(os.path.relpath(staged, app.config['UPLOAD_FOLDER']))
+        elif is_stored_photo_name(photo.filename):
+            filename = release_blob(photo.content_hash)
+            if filename:
+                unused.append(filename)
+        else:
+            unused.append(photo.filename)
+    return unused
+
+
+def store_photo(image, image_format, ext, options):
+    """Encode a processed photo into the store, writing it and its thumbnails unless the same
+    content is already there. Returns (filename, content_hash, byte_size); the caller commits."""
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    data = buffer.getvalue()
+    content_hash = hashlib.sha256(data).hexdigest()
+    filename = stored_photo_name(content_hash, ext)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if acquire_blob(content_hash, filename, len(data)) == 1 or not os.path.exists(path):
+        # The photo itself goes last, so its presence means the thumbnails are there too
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_photo_thumbnails(image, filename)
+        write_upload_file(filename, data)
+    return filename, content_hash, len(data)
+
+
+def migrate_photo_storage(batch_size=PHOTO_BACKFILL_BATCH):
+    """Move flat uploads into the content-addressed store one committed batch at a time, returns photos moved"""
+    folder = app.config['UPLOAD_FOLDER']
+    moved = 0
+    last_id = 0
+    while True:
+        photos = ListingPhoto.query.filter(ListingPhoto.id > last_id, ListingPhoto.ready.is_(True),
+                                           ~ListingPhoto.filename.contains('/')) \
+            .order_by(ListingPhoto.id).limit(batch_size).all()
+        if not photos:
+            return moved
+        retired = []
+        for photo in photos:
+            old_path = os.path.join(folder, photo.filename)
+            metadata = photo_metadata(photo.filename)
+            if metadata['content_hash'] is None:
+                continue  # file is gone; nothing to move
+            ext = os.path.splitext(photo.filename)[1].lstrip('.').lower() or 'jpg'
+            filename = stored_photo_name(metadata['content_hash'], ext)
+            # Guarded on the old name so a worker migrating the same row concurrently counts it once
+            updated = ListingPhoto.query.filter_by(id=photo.id, filename=photo.filename).update(
+                {'filename': filename, 'content_hash': metadata['content_hash'], 'byte_size': metadata['byte_size']},
+                synchronize_session=False)
+            if not updated:
+                continue
+            if acquire_blob(metadata['content_hash'], filename, metadata['byte_size']) == 1 \
+                    or not os.path.exists(os.path.join(folder, filename)):
+                for old_name, name in zip(photo_files(photo.filename)[1:], photo_files(filename)[1:]):
+                    if os.path.exists(os.path.join(folder, old_name)):
+                        write_upload_file(name, source=os.path.join(folder, old_name))
+                write_upload_file(filename, source=old_path)
+            retired.append(photo.filename)
+        db.session.commit()
+        for old_name in retired:
+            remove_photo_files(old_name)
+        moved += len(retired)
+        last_id = photos[-1].id
+
+
+# ---------------------- Photo processing ----------------------
+# post_listing() only stages the raw uploads in PHOTO_STAGING_FOLDER and adds not-ready ListingPhoto
+# rows; a per-process pool of PHOTO_WORKERS threads then validates and decodes each upload,
+# re-encodes it upright without its EXIF data (camera GPS etc.), caps it at PHOTO_MAX_SIZE, writes
+# the thumbnails and marks it ready. Uploads left staged by a worker that died are picked up again,
+# checked every PHOTO_REQUEUE_CHECK seconds, once they are PHOTO_REQUEUE_AFTER seconds old.
+PHOTO_STAGING_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'incoming')
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', 2))
+PHOTO_MAX_SIZE = 2560
+PHOTO_REQUEUE_AFTER = 600
+PHOTO_REQUEUE_CHECK = 60
+
+# A listing page with photos still processing polls their status this often (seconds), and at most
+# this many times, then reloads once when they are done
+PHOTO_POLL_INTERVAL = 3
+PHOTO_POLL_LIMIT = 40
+
+PHOTO_POOL = {"executor": None, "pid": None}
+_photo_pool_lock = threading.Lock()
+
+
+def photo_pool():
+    # A forked worker does not inherit the parent's threads, so each process starts its own pool
+    with _photo_pool_lock:
+        if PHOTO_POOL["pid"] != os.getpid():
+            PHOTO_POOL["executor"] = ThreadPoolExecutor(max_workers=PHOTO_WORKERS, thread_name_prefix='photo-worker')
+            PHOTO_POOL["pid"] = os.getpid()
+        return PHOTO_POOL["executor"]
+
+
+def stage_listing_photos(listing, filenames):
+    """Add not-ready photo rows for uploads saved in PHOTO_STAGING_FOLDER"""
+    for position, filename in enumerate(filenames):
+        listing.listing_photos.append(ListingPhoto(position=position, filename=filename, ready=False))
+
+
+def drop_listing_photo(photo):
+    """Remove a photo that could not be processed, closing the gap in the positions"""
+    listing_id, position = photo.listing_id, photo.position
+    db.session.delete(photo)
+    db.session.flush()
+    later = ListingPhoto.query.filter(ListingPhoto.listing_id == listing_id, ListingPhoto.position > position) \
+        .order_by(ListingPhoto.position).all()
+    for other in later:
+        other.position -= 1
+        db.session.flush()
+
+
+def process_photo(photo):
+    """Turn a staged upload into the stored photo and its thumbnails (the caller commits).
+
+    Returns False when the upload is not a decodable image, after dropping it from the listing.
+    """
+    staged = os.path.join(PHOTO_STAGING_FOLDER, photo.filename)
+    try:
+        with Image.open(staged) as source:
+            source.load()
+            image = ImageOps.exif_transpose(source)
+            icc_profile = source.info.get('icc_profile')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Dropping photo {photo.filename} of listing {photo.listing_id}: {e}")
+        drop_listing_photo(photo)
+        return False
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    image.thumbnail((PHOTO_MAX_SIZE, PHOTO_MAX_SIZE))
+    if has_alpha:
+        ext, image_format, options = 'png', 'PNG', {'optimize': True}
+    else:
+        ext, image_format, options = 'jpg', 'JPEG', {'quality': 88, 'optimize': True, 'progressive': True}
+    # Encoded without the exif argument, so none of the camera metadata is carried over
+    photo.filename, photo.content_hash, photo.byte_size = store_photo(
+        image, image_format, ext, dict(options, icc_profile=icc_profile))
+    photo.width, photo.height = image.size
+    photo.thumbnails = True
+    photo.ready = True
+    return True
+
+
+def process_listing_photos(listing_id):
+    """Pool task: process the staged photos of a listing, committing each as it becomes ready"""
+    try:
+        with app.app_context():
+            photos = ListingPhoto.query.filter_by(listing_id=listing_id, ready=False) \
+                .order_by(ListingPhoto.position).all()
+            for photo in photos:
+                staged = os.path.join(PHOTO_STAGING_FOLDER, photo.filename)
+                if not os.path.exists(staged):
+                    continue  # already handled by another worker
+                process_photo(photo)
+                db.session.commit()
+                os.remove(staged)
+
+            # Listing pages show the photos now, so their validators and cached copies must change
+            listing = db.session.get(Listing, listing_id)
+            if photos and listing is not None:
+                adjust_facet_counts(listing.province, listing.category, 0)
+                db.session.commit()
+                invalidate_listing_pages(listing.province, listing.category)
+    except Exception as e:
+        print(f"Error processing photos of listing {listing_id}: {e}")
+
+
+def queue_listing_photos(listing_id):
+    photo_pool().submit(process_listing_photos, listing_id)
+
+
+def requeue_staged_photos():
+    """Queue listings whose uploads were staged long ago and never processed; returns how many"""
+    cutoff = time.time() - PHOTO_REQUEUE_AFTER
+    listing_ids = set()
+    for photo in ListingPhoto.query.filter_by(ready=False).all():
+        staged = os.path.join(PHOTO_STAGING_FOLDER, photo.filename)
+        try:
+            if os.path.getmtime(staged) < cutoff:
+                # Other workers checking meanwhile now see a fresh upload and leave it to this one
+                os.utime(staged)
+                listing_ids.add(photo.listing_id)
+        except OSError:
+            pass
+    for listing_id in listing_ids:
+        queue_listing_photos(listing_id)
+    return len(listing_ids)
+
+
+def _photo_requeuer():
+    while True:
+        time.sleep(PHOTO_REQUEUE_CHECK)
+        try:
+            with app.app_context():
+                requeued = requeue_staged_photos()
+            if requeued:
+                print(f"Requeued photos of {requeued} listings")
+        except Exception as e:
+            print(f"Error requeueing photos: {e}")
+
+
+# ---------------------- Upload streaming ----------------------
+# Photos are not spooled by Werkzeug: while the multipart body is parsed, each file part of the post
+# form is written in chunks straight to its staged name in PHOTO_STAGING_FOLDER. The extension is
+# checked before any of the part is read and the image signature on its first bytes, and a part or
+# request is cut off with a 413 as soon as it passes MAX_PHOTO_BYTES or MAX_CONTENT_LENGTH. Staged
+# files the view does not claim (rejected or abandoned posts) are removed when the request ends.
+MAX_PHOTOS = 10
+MAX_PHOTO_BYTES = int(os.environ.get('MAX_PHOTO_BYTES', 15 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_PHOTOS * MAX_PHOTO_BYTES + 1024 * 1024  # room for the text fields
+
+PHOTO_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a')
+PHOTO_SIGNATURE_SIZE = 12
+
+
+def is_photo_signature(head):
+    return head.startswith(PHOTO_SIGNATURES) or (head[:4] == b'RIFF' and head[8:12] == b'WEBP')
+
+
+class StagedUpload:
+    """Writable stream for one uploaded photo, backed by its file in PHOTO_STAGING_FOLDER"""
+
+    def __init__(self, client_filename):
+        self.filename = f"{int(time.time())}_{secrets.token_hex(4)}_{secure_filename(client_filename)}"
+        self.path = os.path.join(PHOTO_STAGING_FOLDER, self.filename)
+        self.file = open(self.path, 'w+b')
+        self.size = 0
+        self.head = b''
+        self.claimed = False
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def check_signature(self):
+        if not is_photo_signature(self.head):
+            raise UnsupportedMediaType('Only PNG, JPEG, GIF and WebP photos can be uploaded.')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > MAX_PHOTO_BYTES:
+            raise RequestEntityTooLarge(f'Each photo must be under {MAX_PHOTO_BYTES // (1024 * 1024)} MB.')
+        if len(self.head) < PHOTO_SIGNATURE_SIZE:
+            self.head += data[:PHOTO_SIGNATURE_SIZE - len(self.head)]
+            if len(self.head) == PHOTO_SIGNATURE_SIZE:
+                self.check_signature()
+        return self.file.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # The parser rewinds the stream once the part is complete, which is the last chance to
+        # check uploads shorter than a signature
+        if len(self.head) < PHOTO_SIGNATURE_SIZE:
+            self.check_signature()
+        return self.file.seek(offset, whence)
+
+    def claim(self):
+        """Keep the staged file past the end of the request; returns its name"""
+        self.file.close()
+        self.claimed = True
+        return self.filename
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class UploadRequest(Request):
+    """Request that streams the photos of the post form to PHOTO_STAGING_FOLDER"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.staged_uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != 'post_listing' or not filename or len(self.staged_uploads) >= MAX_PHOTOS:
+            # Empty file inputs and photos past the limit are read through and dropped
+            return open(os.devnull, 'w+b')
+        if os.path.splitext(filename)[1].lower() not in ALLOWED_EXT:
+            raise UnsupportedMediaType(f'Unsupported image type for file {len(self.staged_uploads) + 1}.')
+        if content_length and content_length > MAX_PHOTO_BYTES:
+            raise RequestEntityTooLarge(f'Each photo must be under {MAX_PHOTO_BYTES // (1024 * 1024)} MB.')
+        upload = StagedUpload(filename)
+        self.staged_uploads.append(upload)
+        return upload
+
+
+app.request_class = UploadRequest
+
+
+@app.teardown_request
+def discard_unclaimed_uploads(exc):
+    for upload in request.staged_uploads:
+        if not upload.claimed:
+            upload.discard()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+@app.errorhandler(UnsupportedMediaType)
+def upload_rejected(e):
+    # Raised while the post form is still arriving; the rest of the body is never read
+    if request.endpoint != 'post_listing':
+        return e
+    if e.description == type(e).description:
+        flash('The photos are too large to upload together.', 'danger')
+    else:
+        flash(e.description, 'danger')
+    return redirect(request.url)
+
+
+# ---------------------- Upload sweeping ----------------------
+# Upload files nothing in the database refers to (a delete whose queued removal was lost to a
+# restart, a worker that died mid-write, a post that never committed) are removed by a sweep once
+# they are UPLOAD_SWEEP_GRACE seconds old, so files still being written are never touched. Each
+# worker sweeps after the photo backfill and then every UPLOAD_SWEEP_INTERVAL seconds, checking
+# stored files against photo_blob UPLOAD_SWEEP_BATCH at a time.
+# As a worker pointed at the wrong database (e.g. DATABASE_URL missing, falling back to an empty
+# site.db) would see every file as unreferenced, a sweep never runs against a database without
+# listings or photo blobs, and the automatic ones stop after UPLOAD_SWEEP_MAX_FILES files.
+UPLOAD_SWEEP_INTERVAL = int(os.environ.get('UPLOAD_SWEEP_INTERVAL', 6 * 3600))
+UPLOAD_SWEEP_GRACE = int(os.environ.get('UPLOAD_SWEEP_GRACE', 24 * 3600))
+UPLOAD_SWEEP_BATCH = 500
+UPLOAD_SWEEP_MAX_FILES = int(os.environ.get('UPLOAD_SWEEP_MAX_FILES', 1000))
+
+
+def remove_unused_photos(filenames):
+    """Pool task: remove the files of photos deleted with their listing"""
+    try:
+        with app.app_context():
+            for filename in filenames:
+                remove_unused_photo(filename)
+    except Exception as e:
+        print(f"Error removing photos {filenames}: {e}")
+
+
+def queue_photo_removal(filenames):
+    """Remove upload files in the photo pool rather than in the request"""
+    if filenames:
+        photo_pool().submit(remove_unused_photos, filenames)
+
+
+def sweep_uploads(dry_run=False, max_files=None, force=False):
+    """Remove upload files that are unreferenced and older than UPLOAD_SWEEP_GRACE.
+
+    Stops once max_files are removed. Unless forced, does nothing when the database has no
+    listings and no photo blobs. Returns (files, bytes) removed, or that would be removed with dry_run.
+    """
+    folder = os.path.normpath(app.config['UPLOAD_FOLDER'])
+    if not force and not (db.session.query(Listing.query.exists()).scalar()
+                          or db.session.query(PhotoBlob.query.exists()).scalar()):
+        db.session.rollback()
+        if any(files for _, _, files in os.walk(folder)):
+            print("Upload sweep skipped: the database has no listings or photo blobs, is it the right one?")
+        return 0, 0
+
+    staging = os.path.normpath(PHOTO_STAGING_FOLDER)
+    cutoff = time.time() - UPLOAD_SWEEP_GRACE
+    # Names outside the store (staged uploads, flat photos not migrated yet) are few enough to load whole
+    flat = {name for (name,) in db.session.query(ListingPhoto.filename).filter(~ListingPhoto.filename.contains('/'))}
+    for (photos,) in db.session.query(Listing.photos).filter(Listing.photos.isnot(None), Listing.photos != '',
+                                                              ~Listing.listing_photos.any()):
+        flat.update(f for f in photos.split(',') if f)
+    flat_stems = {os.path.splitext(name)[0] for name in flat}
+    db.session.rollback()
+
+    removed = [0, 0]
+    stored = []
+
+    def full():
+        return max_files is not None and removed[0] >= max_files
+
+    def remove(path, byte_size):
+        if not dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                return
+        removed[0] += 1
+        removed[1] += byte_size
+
+    def sweep_stored():
+        hashes = {content_hash for content_hash, _, _ in stored}
+        kept = {h for (h,) in db.session.query(PhotoBlob.content_hash).filter(PhotoBlob.content_hash.in_(hashes))}
+        db.session.rollback()
+        orphans = {}
+        for content_hash, path, byte_size in stored:
+            if content_hash not in kept:
+                orphans.setdefault(content_hash, []).append((path, byte_size))
+        for content_hash, files in orphans.items():
+            if full():
+                break
+            # Rechecked under the placeholder row, as a photo may have taken the content up since
+            if dry_run or remove_blob_files(content_hash, [path for path, _ in files]):
+                removed[0] += len(files)
+                removed[1] += sum(byte_size for _, byte_size in files)
+        stored.clear()
+
+    for root, dirs, files in os.walk(folder):
+        if full():
+            break
+        relative = os.path.relpath(root, folder)
+        depth = 0 if relative == '.' else relative.count(os.sep) + 1
+        for filename in files:
+            if full():
+                break
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > cutoff:
+                continue
+            if filename.endswith('.tmp'):
+                remove(path, stat.st_size)  # left by an interrupted write_upload_file()
+            elif root == staging:
+                if filename not in flat:
+                    remove(path, stat.st_size)
+            elif depth == UPLOAD_SHARD_DEPTH:
+                # <hash>.<ext> and its <hash>.<size>.<ext> thumbnails share the blob
+                stored.append((filename.split('.')[0], path, stat.st_size))
+                if len(stored) >= UPLOAD_SWEEP_BATCH:
+                    sweep_stored()
+            elif depth == 0:
+                parts = filename.rsplit('.', 2)
+                if len(parts) == 3 and parts[1] in PHOTO_SIZES and parts[2] in PHOTO_FORMATS:
+                    if parts[0] not in flat_stems:
+                        remove(path, stat.st_size)
+                elif filename not in flat:
+                    remove(path, stat.st_size)
+    if stored and not full():
+        sweep_stored()
+    return tuple(removed)
+
+
+def report_upload_sweep(files, byte_size):
+    if files:
+        print(f"Upload sweep: removed {files} orphaned files, reclaimed {byte_size / (1024 * 1024):.1f} MB")
+    if files >= UPLOAD_SWEEP_MAX_FILES:
+        print(f"WARNING: upload sweep stopped at {UPLOAD_SWEEP_MAX_FILES} files, "
+              f"check DATABASE_URL, then run flask sweep-uploads to remove the rest")
+
+
+def _upload_sweeper():
+    while True:
+        time.sleep(UPLOAD_SWEEP_INTERVAL)
+        try:
+            with app.app_context():
+                report_upload_sweep(*sweep_uploads(max_files=UPLOAD_SWEEP_MAX_FILES))
+        except Exception as e:
+            print(f"Error sweeping uploads: {e}")
+
+
+@app.cli.command('sweep-uploads')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed.')
+@click.option('--force', is_flag=True, help='Sweep even when the database has no listings or photos.')
+def sweep_uploads_command(dry_run, force):
+    """Remove upload files no listing photo refers to."""
+    files, byte_size = sweep_uploads(dry_run=dry_run, force=force)
+    print(f"{'Would remove' if dry_run else 'Removed'} {files} files, {byte_size / (1024 * 1024):.1f} MB")
+
+
+# ---------------------- Search suggestions ----------------------
+SUGGEST_LIMIT = 8
+SUGGEST_SCAN_LIMIT = 200          # entries inspected per lookup, bounds the cost of 1-letter prefixes
+SUGGEST_REBUILD_INTERVAL = 300    # seconds; picks up listings posted or deleted by other workers
+SUGGEST_QUERY_MIN_COUNT = 3       # a search must be seen this often before it is suggested
+SUGGEST_MAX_QUERIES = 1000        # distinct searches counted; when full, every count is halved
+
+# Lower ranks are shown first
+SUGGEST_KIND_RANK = {'province': 0, 'category': 1, 'query': 2, 'listing': 3}
+
+
+def normalize_suggestion(text):
+    return ' '.join(text.lower().split())
+
+
+class SuggestionIndex:
+    """In-memory prefix index over listing titles, categories, provinces and popular searches.
+
+    Entries are (key, kind, ref, text) tuples in one sorted list, so a lookup is a bisect to
+    the first key with the prefix followed by a short scan. Titles are indexed from the start
+    of every word, so "corolla" finds "Toyota Corolla".
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.query_counts = {}
+        self.built_at = 0
+        self.rebuilding = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _listing_entries(listing_id, title):
+        key = normalize_suggestion(title or '')
+        entries = []
+        start = 0
+        while key:
+            entries.append((key[start:], 'listing', listing_id, title))
+            start = key.find(' ', start) + 1
+            if not start:
+                break
+        return entries
+
+    def build(self, listings):
+        entries = [(normalize_suggestion(p), 'province', p, p) for p in PROVINCES]
+        entries += [(normalize_suggestion(c), 'category', c, c) for c in CATEGORIES]
+        for listing_id, title in listings:
+            entries.extend(self._listing_entries(listing_id, title))
+        with self.lock:
+            entries += [(q, 'query', q, q) for q, n in self.query_counts.items() if n >= SUGGEST_QUERY_MIN_COUNT]
+            entries.sort()
+            self.entries = entries
+            self.built_at = time.time()
+
+    def add_listing(self, listing_id, title):
+        if not self.built_at:
+            return
+        with self.lock:
+            for entry in self._listing_entries(listing_id, title):
+                bisect.insort(self.entries, entry)
+
+    def remove_listing(self, listing_id, title):
+        if not self.built_at:
+            return
+        with self.lock:
+            for entry in self._listing_entries(listing_id, title):
+                i = bisect.bisect_left(self.entries, entry)
+                if i < len(self.entries) and self.entries[i] == entry:
+                    del self.entries[i]
+
+    def record_query(self, q):
+        q = normalize_suggestion(q)
+        if not q or len(q) > 100:
+            return
+        with self.lock:
+            while q not in self.query_counts and len(self.query_counts) >= SUGGEST_MAX_QUERIES:
+                self._decay_queries()
+            self.query_counts[q] = self.query_counts.get(q, 0) + 1
+            if self.built_at and self.query_counts[q] == SUGGEST_QUERY_MIN_COUNT:
+                bisect.insort(self.entries, (q, 'query', q, q))
+
+    def _decay_queries(self):
+        # Halving makes room for new searches (those seen once drop out) while keeping the order of
+        # the popular ones; searches that fall below SUGGEST_QUERY_MIN_COUNT stop being suggested
+        self.query_counts = {q: n // 2 for q, n in self.query_counts.items() if n > 1}
+        self.entries = [entry for entry in self.entries
+                        if entry[1] != 'query' or self.query_counts.get(entry[0], 0) >= SUGGEST_QUERY_MIN_COUNT]
+
+    def lookup(self, prefix, limit=SUGGEST_LIMIT):
+        key = normalize_suggestion(prefix)
+        if not key:
+            return []
+        found = {}
+        with self.lock:
+            entries = self.entries
+            i = bisect.bisect_left(entries, (key,))
+            end = min(len(entries), i + SUGGEST_SCAN_LIMIT)
+            while i < end and entries[i][0].startswith(key):
+                _, kind, ref, text = entries[i]
+                found.setdefault((kind, ref), text)
+                i += 1
+        ranked = sorted(found.items(), key=lambda item: (SUGGEST_KIND_RANK[item[0][0]], len(item[1])))
+        return [{'kind': kind, 'ref': ref, 'text': text} for (kind, ref), text in ranked[:limit]]
+
+
+SUGGESTIONS = SuggestionIndex()
+
+
+def _rebuild_suggestions():
+    try:
+        with app.app_context():
+            SUGGESTIONS.build(db.session.query(Listing.id, Listing.title).yield_per(1000))
+    except Exception as e:
+        print(f"Error rebuilding suggestions: {e}")
+    finally:
+        SUGGESTIONS.rebuilding = False
+
+
+def ensure_suggestions():
+    # The first lookup in a worker builds the index; after that a stale index is rebuilt
+    # in the background while the old one keeps answering.
+    if not SUGGESTIONS.built_at:
+        _rebuild_suggestions()
+    elif time.time() - SUGGESTIONS.built_at > SUGGEST_REBUILD_INTERVAL and not SUGGESTIONS.rebuilding:
+        SUGGESTIONS.rebuilding = True
+        threading.Thread(target=_rebuild_suggestions, name='suggestions-rebuild', daemon=True).start()
+
+
+# The static build commands run at deploy time, when neither the database nor the upload disk
+# may be reachable, so importing the app for them must not touch either
+STATIC_BUILD_COMMANDS = {'build-assets', 'precompress-static'}
+
+
+def init_database():
+    """Create tables, migrate, seed the default data and start the photo background threads"""
+    with app.app_context():
+        db.create_all()
+        migrate_database()
+        # Listings posted before ListingPhoto existed are moved over in the background
+        threading.Thread(target=_photo_backfill, name='photo-backfill', daemon=True).start()
+        threading.Thread(target=_upload_sweeper, name='upload-sweeper', daemon=True).start()
+        threading.Thread(target=_photo_requeuer, name='photo-requeuer', daemon=True).start()
+        # Initialize default data only if no users exist
+        if User.query.count() == 0:
+            # Default sponsors - UPDATED with Horizon Vehicles
+            if Sponsor.query.count() == 0:
+                default_sponsors = [
+                    {"name": "Hitbay Sanitation", "image": "hitbay.jpg", "url": "https://www.hitbaysanitation.co.zw"},
+                    {"name": "Horizon Vehicles", "image": "horizonvehicles.jpg", "url": "https://horizonvehicles.com/country/zimbabwe"}             ]
+                for sponsor_data in default_sponsors:
+                    sponsor = Sponsor(**sponsor_data)
+                    db.session.add(sponsor)
+
+            # Default admin user
+            if User.query.filter_by(email="admin@263explosion.com").first() is None:
+                admin_user = User(
+                    email="admin@263explosion.com",
+                    name="Admin",
+                    password_hash=generate_password_hash("test123")
+                )
+                db.session.add(admin_user)
+
+            # Default regular user
+            if User.query.filter_by(email="user@263explosion.com").first() is None:
+                regular_user = User(
+                    email="user@263explosion.com",
+                    name="Zimbo User",
+                    password_hash=generate_password_hash("263explosion")
+                )
+                db.session.add(regular_user)
+
+            db.session.commit()
+            print("Default data initialized")
+
+
+
+if not STATIC_BUILD_COMMANDS.intersection(sys.argv[1:]):
+    init_database()
 
 
 # Helper functions
@@ -260,14 +2246,544 @@ def login_required(view_func):
     return wrapper
 
 
+# ---------------------- Page cache ----------------------
+# Rendered pages for logged-out visitors, per worker. Entries carry tags naming the listings they
+# show so a write only drops the pages it affects; the TTL bounds how stale other workers can be.
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 256))
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 60))
+
+# The args that change what a page shows. The same allow-list as page_url(), so whatever the key
+# ignores (tracking params, _external etc.) can never end up in the cached page's links either
+PAGE_CACHE_ARGS = PAGE_ARGS
+
+
+class PageCache:
+    """Bounded LRU of rendered pages with tag-based invalidation"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires_at, body, mimetype, tags)
+        self.tags = {}                # tag -> set of keys
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, mimetype, tags, ttl):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.time() + ttl, body, mimetype, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _drop(self, key):
+        _, _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+
+PAGE_CACHE = PageCache(PAGE_CACHE_MAX_ENTRIES)
+
+
+def listing_tags(province=None, category=None):
+    """Cache tags of the pages that show listings from province/category"""
+    tags = {'listings'}
+    if province:
+        tags.add(f'province:{province}')
+        if category:
+            tags.add(f'category:{province}/{category}')
+    return tags
+
+
+def invalidate_listing_pages(province, category):
+    PAGE_CACHE.invalidate(*listing_tags(province, category))
+
+
+def cache_stream(key, chunks, mimetype, tags, ttl):
+    """Pass a streamed page through, caching it once it has been sent in full"""
+    sent = []
+    try:
+        for chunk in chunks:
+            sent.append(chunk if isinstance(chunk, bytes) else chunk.encode())
+            yield chunk
+    finally:
+        # Closing the inner stream tears down the request context it kept alive
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    PAGE_CACHE.put(key, b''.join(sent), mimetype, tags, ttl)
+
+
+def cached_page(tags=None, ttl=None):
+    """Serve the view from PAGE_CACHE for anonymous visitors.
+
+    tags is called with the view arguments and returns the entry's tags.
+    """
+    def decorator(view_func):
+        def wrapper(*args, **kwargs):
+            # Logged-in users see their own nav and delete buttons, and pending flash
+            # messages are one-off, so neither may be served from or stored in the cache
+            if request.method != 'GET' or 'user_id' in session or '_flashes' in session:
+                return view_func(*args, **kwargs)
+
+            # conditional_page() leaves the data version in g, so other workers' writes miss the cache too
+            key = (request.path, tuple(sorted((k, v) for k, v in request.args.items(multi=True) if k in PAGE_CACHE_ARGS)),
+                   g.get('page_version'))
+            entry = PAGE_CACHE.get(key)
+            if entry is not None:
+                response = make_response(entry[1])
+                response.mimetype = entry[2]
+                response.headers['X-Page-Cache'] = 'HIT'
+                return response
+
+            response = make_response(view_func(*args, **kwargs))
+            if response.status_code == 200:
+                entry_tags = tags(**kwargs) if tags else set()
+                if response.is_streamed:
+                    response.response = cache_stream(key, response.response, response.mimetype, entry_tags,
+                                                      ttl or PAGE_CACHE_TTL)
+                else:
+                    PAGE_CACHE.put(key, response.get_data(), response.mimetype, entry_tags, ttl or PAGE_CACHE_TTL)
+                response.headers['X-Page-Cache'] = 'MISS'
+            return response
+
+        wrapper.__name__ = view_func.__name__
+        return wrapper
+
+    return decorator
+
+
+# ---------------------- Conditional GET ----------------------
+# Listing pages carry a weak ETag built from cheap validator queries (a facet row lookup, or the
+# listing's id and creation time), so a browser revalidating an unchanged page gets a 304 before
+# anything is queried for or rendered. View counts are deliberately left out of the validators.
+DEPLOY_VERSION = os.environ.get('RENDER_GIT_COMMIT') or str(int(os.path.getmtime(__file__)))
+
+
+def facet_validator(province='', category=''):
+    """Version and Last-Modified of the listings in a facet ('' for all provinces/categories)"""
+    facet = db.session.get(ListingFacet, (province, category))
+    if facet is None or facet.updated_at is None:
+        return f'{province}/{category}:empty', None
+    version = f'{province}/{category}:{facet.listing_count}:{facet.updated_at.isoformat()}'
+    # Popularity order moves as views are flushed, so those pages also expire with the page cache TTL
+    if request.args.get('sort') == 'popular':
+        version += f':{int(time.time() // PAGE_CACHE_TTL)}'
+    return version, facet.updated_at
+
+
+def conditional_page(validator, not_modified=None):
+    """Answer If-None-Match / If-Modified-Since with 304 when the page's data is unchanged.
+
+    validator is called with the view arguments and returns (version, last_modified), or
+    None to serve the view unconditionally; not_modified runs instead of the view on a 304.
+    """
+    def decorator(view_func):
+        def wrapper(*args, **kwargs):
+            # Flash messages are one-off, so those responses must never be revalidated
+            if request.method != 'GET' or '_flashes' in session:
+                return view_func(*args, **kwargs)
+            validators = validator(**kwargs)
+            if validators is None:
+                return view_func(*args, **kwargs)
+
+            version, last_modified = validators
+            user_id = session.get('user_id')
+            etag = hashlib.sha1(f'{DEPLOY_VERSION}|{user_id}|{version}'.encode()).hexdigest()[:20]
+            if last_modified is not None:
+                last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                if not_modified:
+                    not_modified(**kwargs)
+                response = make_response('', 304)
+            else:
+                g.page_version = version
+                response = make_response(view_func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            # Logged-in pages carry the user's nav, so shared caches must not keep them
+            if user_id:
+                response.cache_control.private = True
+            else:
+                response.cache_control.public = True
+            return response
+
+        wrapper.__name__ = view_func.__name__
+        return wrapper
+
+    return decorator
+
+
+# ---------------------- Compression ----------------------
+# Text responses of COMPRESS_MIN_SIZE bytes or more are sent brotli or gzip encoded, whichever the
+# client accepts (brotli first). Static files are served from the .br/.gz copies written once by
+# `flask precompress-static` at build time, when the copy is newer than the file.
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = {'br': 5, 'gzip': 6}        # per response, kept cheap
+PRECOMPRESS_LEVEL = {'br': 11, 'gzip': 9}    # once per build
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                      'application/json', 'application/xml', 'image/svg+xml'}
+PRECOMPRESS_EXTENSIONS = {'.css', '.js', '.mjs', '.json', '.map', '.svg', '.txt', '.xml', '.html'}
+
+
+def accepted_encoding():
+    """'br', 'gzip' or None, by the request's Accept-Encoding"""
+    best, best_quality = None, 0
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        quality = request.accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    """Compress a streamed body chunk by chunk, flushing each so streaming still reaches the client"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_LEVEL['br'])
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL['gzip'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        for chunk in chunks:
+            yield process(chunk if isinstance(chunk, bytes) else chunk.encode()) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+@app.after_request
+def compress_response(response):
+    # send_file responses (static files) are passed through; they have precompressed copies instead
+    if (response.direct_passthrough or response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding, COMPRESS_LEVEL[encoding]))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def precompressed_copy(path, encoding):
+    """The .br/.gz copy of a static file if it is at least as new as the file, else None"""
+    copy = path + ENCODING_SUFFIXES[encoding]
+    try:
+        if os.path.getmtime(copy) >= os.path.getmtime(path):
+            return copy
+    except OSError:
+        pass
+    return None
+
+
+def precompress_static():
+    """Write missing or stale .br/.gz copies of the compressible static files; returns how many"""
+    upload_folder = os.path.abspath(app.config['UPLOAD_FOLDER'])
+    written = 0
+    for root, dirs, files in os.walk(app.static_folder):
+        if os.path.abspath(root) == upload_folder:
+            dirs[:] = []
+            continue
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1].lower() not in PRECOMPRESS_EXTENSIONS or os.path.getsize(path) < COMPRESS_MIN_SIZE:
+                continue
+            data = None
+            for encoding, suffix in ENCODING_SUFFIXES.items():
+                if (encoding == 'br' and brotli is None) or precompressed_copy(path, encoding):
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                # Written under a temporary name so a running worker never serves half a file
+                tmp_path = f'{path}{suffix}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(compress(data, encoding, PRECOMPRESS_LEVEL[encoding]))
+                os.replace(tmp_path, path + suffix)
+                written += 1
+    return written
+
+
+@app.cli.command('precompress-static')
+def precompress_static_command():
+    """Write brotli and gzip copies of the static text assets (run at build time)."""
+    print(f"Precompressed {precompress_static()} static files")
+
+
+# ---------------------- Static assets ----------------------
+# `flask build-assets` (run at build time) fingerprints every static file by content and writes
+# AVIF/WebP variants of the site images to static/build, recording both in a manifest. url_for('static')
+# then hands out the fingerprinted names, which are served with a one-year immutable Cache-Control;
+# the image behind such a URL is the smallest variant the browser accepts. Without a manifest
+# (local development) plain names are used.
+ASSET_BUILD_DIR = 'build'
+ASSET_MANIFEST_PATH = os.path.join(app.static_folder, ASSET_BUILD_DIR, 'manifest.json')
+ASSET_MAX_AGE = 365 * 24 * 3600
+ASSET_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# Checked in this order; AVIF is skipped when Pillow was built without it
+IMAGE_VARIANT_FORMATS = {
+    'image/avif': ('AVIF', '.avif', {'quality': 55}),
+    'image/webp': ('WEBP', '.webp', {'quality': 80, 'method': 6}),
+}
+# Sponsor logos are shown at most 120px high, so their variants are scaled down to twice that
+ASSET_IMAGE_MAX_SIZE = {'img/sponsors/': (720, 240)}
+DEFAULT_IMAGE_MAX_SIZE = (1920, 1920)
+
+ASSET_MANIFEST = {'files': {}, 'variants': {}}  # name -> fingerprinted name, name -> {mimetype: variant}
+ASSET_SOURCES = {}                              # fingerprinted name -> name
+
+
+def load_asset_manifest():
+    try:
+        with open(ASSET_MANIFEST_PATH) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {'files': {}, 'variants': {}}
+    ASSET_MANIFEST.update(manifest)
+    ASSET_SOURCES.clear()
+    ASSET_SOURCES.update({fingerprinted: name for name, fingerprinted in manifest['files'].items()})
+
+
+load_asset_manifest()
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static':
+        fingerprinted = ASSET_MANIFEST['files'].get(values.get('filename'))
+        if fingerprinted:
+            values['filename'] = fingerprinted
+
+
+def accepted_image_type(variants):
+    # Browsers name the modern formats they decode, so a bare */* does not count
+    for mimetype in IMAGE_VARIANT_FORMATS:
+        if mimetype in variants and any(value == mimetype and quality > 0
+                                        for value, quality in request.accept_mimetypes):
+            return mimetype
+    return None
+
+
+def serve_static(filename):
+    """Flask's static view, resolving fingerprinted names and answering with an image variant
+    or a precompressed copy when the client accepts one"""
+    name = ASSET_SOURCES.get(filename, filename)
+    # Normalised first, as send_from_directory() would also serve uploads/./incoming/<file> and the like
+    if posixpath.normpath(name).lstrip('/').startswith('uploads/incoming/'):
+        abort(404)  # raw uploads awaiting processing, EXIF data and all
+    path = safe_join(app.static_folder, name)
+    variants = ASSET_MANIFEST['variants'].get(name, {})
+    sent, mimetype = name, mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    image_type = accepted_image_type(variants)
+    encoding = None if image_type else accepted_encoding()
+    if image_type:
+        sent, mimetype = variants[image_type], image_type
+    elif path and encoding and precompressed_copy(path, encoding):
+        sent = name + ENCODING_SUFFIXES[encoding]
+    else:
+        encoding = None
+
+    fingerprinted = filename in ASSET_SOURCES
+    response = send_from_directory(app.static_folder, sent, mimetype=mimetype,
+                                   max_age=ASSET_MAX_AGE if fingerprinted else app.get_send_file_max_age(name))
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if variants:
+        response.vary.add('Accept')
+    if os.path.splitext(name)[1].lower() in PRECOMPRESS_EXTENSIONS:
+        response.vary.add('Accept-Encoding')
+    if fingerprinted:
+        response.cache_control.immutable = True
+    return response
+
+
+app.view_functions['static'] = serve_static
+
+
+def write_image_variants(path, name):
+    """Write the AVIF/WebP variants of a static image that come out smaller than it.
+
+    Returns {mimetype: variant path under the static folder}.
+    """
+    variants = {}
+    max_size = next((size for prefix, size in ASSET_IMAGE_MAX_SIZE.items() if name.startswith(prefix)),
+                    DEFAULT_IMAGE_MAX_SIZE)
+    image = None
+    for mimetype, (image_format, suffix, options) in IMAGE_VARIANT_FORMATS.items():
+        if not features.check(image_format.lower()):
+            continue
+        variant = f'{ASSET_BUILD_DIR}/{name}{suffix}'
+        target = os.path.join(app.static_folder, variant)
+        if not (os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path)):
+            if image is None:
+                with Image.open(path) as source:
+                    image = source.convert('RGBA' if source.mode in ('RGBA', 'LA', 'PA') or 'transparency' in source.info
+                                           else 'RGB')
+                image.thumbnail(max_size)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            image.save(target, image_format, **options)
+        if os.path.getsize(target) < os.path.getsize(path):
+            variants[mimetype] = variant
+    return variants
+
+
+def build_assets():
+    """Fingerprint the static files, write the image variants and save the manifest"""
+    skipped = {os.path.abspath(app.config['UPLOAD_FOLDER']), os.path.join(os.path.abspath(app.static_folder), ASSET_BUILD_DIR)}
+    manifest = {'files': {}, 'variants': {}}
+    for root, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skipped]
+        for filename in files:
+            stem, ext = os.path.splitext(filename)
+            if ext in ('.br', '.gz'):
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read())
+            if ext.lower() in ASSET_IMAGE_EXTENSIONS and name.startswith('img/'):
+                variants = write_image_variants(path, name)
+                if variants:
+                    manifest['variants'][name] = variants
+                # The URL serves the variants as well, so they are part of its fingerprint
+                for variant in sorted(variants.values()):
+                    with open(os.path.join(app.static_folder, variant), 'rb') as f:
+                        digest.update(f.read())
+            manifest['files'][name] = f'{name[:len(name) - len(filename)]}{stem}.{digest.hexdigest()[:10]}{ext}'
+
+    os.makedirs(os.path.dirname(ASSET_MANIFEST_PATH), exist_ok=True)
+    tmp_path = f'{ASSET_MANIFEST_PATH}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, ASSET_MANIFEST_PATH)
+    return manifest
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint static files and write AVIF/WebP image variants (run at build time)."""
+    manifest = build_assets()
+    print(f"Fingerprinted {len(manifest['files'])} static files, "
+          f"{sum(len(v) for v in manifest['variants'].values())} image variants")
+
+
 def get_sponsors_from_db():
     return Sponsor.query.filter_by(is_active=True).all()
 
 
-def default_nav(user):
-    # Create the navigation HTML without using template variables
+# Active sponsors change a few times a year, so each worker keeps them as immutable records with
+# the logo URL already built. A committed write to a Sponsor row drops this worker's copy and the
+# cached pages showing them; other workers pick the change up within SPONSOR_CACHE_TTL seconds.
+SPONSOR_CACHE_TTL = int(os.environ.get('SPONSOR_CACHE_TTL', 600))
+
+SponsorRecord = namedtuple('SponsorRecord', 'name image url image_url')
+
+SPONSOR_CACHE = {"sponsors": None, "version": '', "loaded_at": 0}
+_sponsor_lock = threading.Lock()
+
+
+def get_sponsors():
+    """Active sponsors as a tuple of SponsorRecords, read from the database at most once per TTL"""
+    with _sponsor_lock:
+        if SPONSOR_CACHE["sponsors"] is None or time.time() - SPONSOR_CACHE["loaded_at"] > SPONSOR_CACHE_TTL:
+            sponsors = tuple(SponsorRecord(s.name, s.image, s.url,
+                                           url_for('static', filename='img/sponsors/' + s.image))
+                             for s in get_sponsors_from_db())
+            SPONSOR_CACHE.update(sponsors=sponsors, loaded_at=time.time(),
+                                 version=hashlib.sha1(repr(sponsors).encode()).hexdigest()[:12])
+        return SPONSOR_CACHE["sponsors"]
+
+
+def sponsors_version():
+    get_sponsors()
+    return SPONSOR_CACHE["version"]
+
+
+def invalidate_sponsors():
+    with _sponsor_lock:
+        SPONSOR_CACHE["sponsors"] = None
+    PAGE_CACHE.invalidate('sponsors')
+
+
+@event.listens_for(db.session, 'after_flush')
+def _note_sponsor_writes(session, flush_context):
+    if any(isinstance(obj, Sponsor) for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info['sponsors_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _drop_stale_sponsors(session):
+    # After the commit, so the reload cannot read the rows as they were
+    if session.info.pop('sponsors_changed', False):
+        invalidate_sponsors()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_sponsor_writes(session):
+    session.info.pop('sponsors_changed', None)
+
+
+# The sectors and markets menus only depend on SECTORS and the URL map, which is fixed once the
+# app serves requests, so they are built once per process and reused; only the user part is per request.
+NAV_CACHE = {"key": None, "html": ""}
+
+
+def build_static_nav():
     sectors_html = ''.join(
-        [f'<li><a class="dropdown-item" href="{url_for("invest_sector", sector=s)}">{s}</a></li>' for s in SECTORS])
+        [f'<li><a class="dropdown-item" href="{url_for("invest_sector", sector=s)}">{escape(s)}</a></li>' for s in SECTORS])
 
     return f'''
       <li class="nav-item dropdown">
@@ -287,16 +2803,46 @@ def default_nav(user):
           <li><a class="dropdown-item" href="{url_for('markets')}">Overview</a></li>
         </ul>
       </li>
-      {f'<li class="nav-item me-2"><a href="{url_for("post_listing")}" class="btn btn-outline-warning btn-sm">Post</a></li><li class="nav-item"><span class="text-white-50 small me-2">Welcome, {user.name}</span></li><li class="nav-item"><a href="{url_for("logout")}" class="btn btn-outline-light btn-sm">Logout</a></li>' if user else f'<li class="nav-item"><a href="{url_for("login")}" class="btn btn-danger btn-sm">Login</a></li>'}
-    '''
+      '''
 
 
-# Market data functions
-def get_live_currencies(ttl=600):
-    now = time.time()
-    if now - CACHE["currencies"]["ts"] < ttl and CACHE["currencies"]["data"][0]["rate"] != "-":
-        return CACHE["currencies"]["data"]
+def user_nav(user):
+    if user:
+        return (f'<li class="nav-item me-2"><a href="{url_for("post_listing")}" class="btn btn-outline-warning btn-sm">Post</a></li>'
+                f'<li class="nav-item"><span class="text-white-50 small me-2">Welcome, {escape(user.name)}</span></li>'
+                f'<li class="nav-item"><a href="{url_for("logout")}" class="btn btn-outline-light btn-sm">Logout</a></li>')
+    return f'<li class="nav-item"><a href="{url_for("login")}" class="btn btn-danger btn-sm">Login</a></li>'
+
+
+def default_nav(user):
+    # url_for() output also depends on the mount point, so it is part of the cache key
+    key = (tuple(SECTORS), request.script_root)
+    if NAV_CACHE["key"] != key:
+        NAV_CACHE["html"] = build_static_nav()
+        NAV_CACHE["key"] = key
+    return NAV_CACHE["html"] + user_nav(user)
+
+
+@app.cli.command('bench-nav')
+@click.option('--iterations', default=20000, help='Navigation renders per variant.')
+def bench_nav_command(iterations):
+    """Time building the navigation from scratch against the cached fragment."""
+    class Visitor:
+        name = 'Benchmark User'
+
+    with app.test_request_context('/'):
+        for label, build in (('uncached', lambda: build_static_nav() + user_nav(Visitor)),
+                             ('cached', lambda: default_nav(Visitor))):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                build()
+            elapsed = time.perf_counter() - start
+            print(f"{label:>9}: {elapsed / iterations * 1e6:8.2f} us per nav ({iterations} iterations)")
+
 
+# Market data functions
+def fetch_currencies():
+    """Rates from the first currency API that answers, None if none does"""
     try:
         apis_to_try = [
             "https://api.exchangerate.host/latest?base=USD",
@@ -318,7 +2864,7 @@ def get_live_currencies(ttl=600):
 
         if not rates:
             print("All currency APIs failed, using cached data")
-            return CACHE["currencies"]["data"]
+            return None
 
         zwl_rate = rates.get('ZWL') or 322.0
 
@@ -331,19 +2877,15 @@ def get_live_currencies(ttl=600):
             {"pair": "CNY/USD", "rate": f"{1 / rates.get('CNY', 7.25):,.4f}" if rates.get('CNY') else "N/A"},
         ]
 
-        CACHE["currencies"] = {"ts": now, "data": out}
         return out
 
     except Exception as e:
         print(f"Error fetching currencies: {e}")
-        return CACHE["currencies"]["data"]
+        return None
 
 
-def get_live_metals(ttl=600):
-    now = time.time()
-    if now - CACHE["metals"]["ts"] < ttl and CACHE["metals"]["data"][0]["price"] != "-":
-        return CACHE["metals"]["data"]
-
+def fetch_metals():
+    """Metal prices, the precious metals from the metals API when it answers"""
     try:
         metals_data = []
 
@@ -399,62 +2941,100 @@ def get_live_metals(ttl=600):
             {"metal": "Nickel (t)", "price": "$18,500.00"}
         ])
 
-        CACHE["metals"] = {"ts": now, "data": metals_data}
         return metals_data
 
     except Exception as e:
         print(f"Error fetching metals: {e}")
-        return [
-            {"metal": "Gold (oz)", "price": "$1,950.00"},
-            {"metal": "Platinum (oz)", "price": "$950.00"},
-            {"metal": "Palladium (oz)", "price": "$1,200.00"},
-            {"metal": "Silver (oz)", "price": "$23.50"},
-            {"metal": "Copper (lb)", "price": "$3.85"},
-            {"metal": "Chrome (t)", "price": "$280.00"},
-            {"metal": "Iron Ore (t)", "price": "$120.00"},
-            {"metal": "Lithium (t)", "price": "$15,400.00"},
-            {"metal": "Graphite (t)", "price": "$850.00"},
-            {"metal": "Nickel (t)", "price": "$18,500.00"}
-        ]
+        return None
+
+
+# Market pages never wait on the upstream APIs: they show the last good CACHE entry, while one
+# refresher thread per worker (so at most one fetch per entry is ever in flight) fetches each
+# entry again once it is MARKET_REFRESH_AHEAD of MARKET_DATA_TTL old, before it expires. A failed
+# fetch keeps the old value and is retried on the next check.
+MARKET_DATA_TTL = int(os.environ.get('MARKET_DATA_TTL', 600))
+MARKET_REFRESH_AHEAD = 0.8
+MARKET_REFRESH_CHECK = 30  # seconds between checks
+
+MARKET_FETCHERS = {"currencies": fetch_currencies, "metals": fetch_metals}
+MARKET_REFRESHER = {"pid": None}
+_market_lock = threading.Lock()
+
+
+def market_data_age(name):
+    """Seconds since CACHE[name] was fetched, None while it still holds the placeholders"""
+    ts = CACHE[name]["ts"]
+    return time.time() - ts if ts else None
+
+
+def refresh_market_data(name):
+    data = MARKET_FETCHERS[name]()
+    if data:
+        CACHE[name] = {"ts": time.time(), "data": data}
+        PAGE_CACHE.invalidate(f'markets:{name}')
+    return bool(data)
+
+
+def _market_refresher():
+    while True:
+        for name in MARKET_FETCHERS:
+            age = market_data_age(name)
+            if age is None or age >= MARKET_DATA_TTL * MARKET_REFRESH_AHEAD:
+                try:
+                    refresh_market_data(name)
+                except Exception as e:
+                    print(f"Error refreshing {name}: {e}")
+        time.sleep(MARKET_REFRESH_CHECK)
+
+
+def start_market_refresher():
+    # One refresher thread per worker process, started by the first market page it serves
+    if MARKET_REFRESHER["pid"] == os.getpid():
+        return
+    with _market_lock:
+        if MARKET_REFRESHER["pid"] == os.getpid():
+            return
+        MARKET_REFRESHER["pid"] = os.getpid()
+    threading.Thread(target=_market_refresher, name='market-refresher', daemon=True).start()
+
+
+def get_live_currencies():
+    start_market_refresher()
+    return CACHE["currencies"]["data"]
+
+
+def get_live_metals():
+    start_market_refresher()
+    return CACHE["metals"]["data"]
 
 
 # Routes
 @app.route('/')
+@conditional_page(lambda: home_validator())
+@cached_page(tags=lambda: listing_tags() | {'sponsors'})
 def home():
     q = request.args.get('q', '').strip().lower()
     province_filter = request.args.get('province', '')
     sort_by = request.args.get('sort', 'newest')  # Default to newest
 
     results = []
+    next_cursor = None
+    fuzzy = False
 
     if q:
-        results = Listing.query.filter(
-            db.or_(
-                Listing.title.ilike(f'%{q}%'),
-                Listing.category.ilike(f'%{q}%'),
-                Listing.description.ilike(f'%{q}%')
-            )
-        )
-        if province_filter:
-            results = results.filter(Listing.province == province_filter)
-
-        # Apply sorting for search results
-        if sort_by == 'popular':
-            results = results.order_by(Listing.view_count.desc())
-        else:  # newest
-            results = results.order_by(Listing.created_at.desc())
-
-        results = results.all()
+        SUGGESTIONS.record_query(q)
+        # Sorted and paged search results, close matches when nothing matches exactly
+        results, next_cursor, fuzzy = find_listings(q, province_filter, sort_by, page_size(), stream=STREAM_PAGES)
     else:
         # Show only 6 recent/popular listings when no search
         if sort_by == 'popular':
-            results = Listing.query.order_by(Listing.view_count.desc()).limit(6).all()
+            results = Listing.query.order_by(Listing.popularity.desc()).limit(6).all()
         else:  # newest
             results = Listing.query.order_by(Listing.created_at.desc()).limit(6).all()
 
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
-    sponsors = get_sponsors_from_db()
+    sponsors = get_sponsors()
 
     # Updated home template with sorting options
     home_template = '''
@@ -523,7 +3103,8 @@ def home():
           {% endfor %}
         {% endwith %}
         <form method="get" class="search-bar d-flex flex-wrap shadow-sm" enctype="multipart/form-data">
-          <input class="form-control me-2 mb-2" name="q" placeholder="Search cars, houses, jobs…" value="{{ request.args.get('q','') }}">
+          <input class="form-control me-2 mb-2" name="q" placeholder="Search cars, houses, jobs…" value="{{ request.args.get('q','') }}" list="suggestions" autocomplete="off">
+          <datalist id="suggestions"></datalist>
           <select name="province" class="form-select me-2 mb-2" style="max-width:220px;">
             <option value="">All Provinces</option>
             {% for p in provinces %}
@@ -533,6 +3114,7 @@ def home():
           <select name="sort" class="form-select me-2 mb-2 sort-options">
             <option value="newest" {% if request.args.get('sort','newest')=='newest' %}selected{% endif %}>Newest First</option>
             <option value="popular" {% if request.args.get('sort','newest')=='popular' %}selected{% endif %}>Most Popular</option>
+            <option value="relevance" {% if request.args.get('sort','newest')=='relevance' %}selected{% endif %}>Best Match</option>
           </select>
           <button class="btn btn-danger mb-2">Search</button>
         </form>
@@ -542,6 +3124,7 @@ def home():
               <h5 class="mb-0">
                 {% if request.args.get('q') %}
                   Search results for "{{ request.args.get('q') }}"
+                  {% if fuzzy %}<small class="text-muted d-block mt-1">No exact matches, showing close matches</small>{% endif %}
                 {% else %}
                   Featured Listings
                   {% if not request.args.get('q') %}
@@ -558,12 +3141,8 @@ def home():
               {% for r in results %}
                 <div class="col-12 col-md-6 col-lg-4">
                   <div class="card shadow-sm h-100 listing-card" onclick="window.location=\'{{ url_for("listing_detail", listing_id=r.id) }}\'">
-                    {% if r.photos %}
-                      {% set photo_list = r.photos.split(',') %}
-                      {% set first_photo = photo_list[0] %}
-                      <img src="{{ url_for('static', filename='uploads/' + first_photo) }}" class="card-img-top" alt="photo" style="height: 200px; object-fit: cover;">
-                    {% elif r.photo %}
-                      <img src="{{ url_for('static', filename='uploads/' + r.photo) }}" class="card-img-top" alt="photo" style="height: 200px; object-fit: cover;">
+                    {% if covers.get(r.id) %}
+                      {{ photo_picture(covers[r.id], 'card', class_='card-img-top', alt='photo', style='height: 200px; object-fit: cover;') }}
                     {% endif %}
                     <div class="card-body">
                       <h5 class="mb-1">{{ r.title }}</h5>
@@ -591,6 +3170,12 @@ def home():
                 </div>
               {% endfor %}
               </div>
+              {% if next_url or first_url %}
+                <div class="d-flex justify-content-center gap-2 mt-4">
+                  {% if first_url %}<a href="{{ first_url }}" class="btn btn-outline-secondary">« First page</a>{% endif %}
+                  {% if next_url %}<a href="{{ next_url }}" class="btn btn-danger">Next page »</a>{% endif %}
+                </div>
+              {% endif %}
             {% else %}
               <div class="text-muted">No results found.</div>
             {% endif %}
@@ -601,7 +3186,7 @@ def home():
         <div class="container mt-3">
           <div class="row justify-content-center g-3">
             {% for p in provinces %}
-              <div class="col-6 col-md-3"><a class="province-card shadow-sm" href="{{ url_for('province_page', province=p) }}">{{ p }}</a></div>
+              <div class="col-6 col-md-3"><a class="province-card shadow-sm" href="{{ url_for('province_page', province=p) }}">{{ p }}<span class="d-block small fw-normal text-capitalize">{{ province_counts.get(p, 0) }} listings</span></a></div>
             {% endfor %}
           </div>
         </div>
@@ -616,7 +3201,7 @@ def home():
               {% for sponsor in sponsors %}
                 <div class="text-center">
                   <a href="{{ sponsor.url }}" target="_blank">
-                    <img src="{{ url_for('static', filename='img/sponsors/' + sponsor.image) }}" 
+                    <img src="{{ sponsor.image_url }}" 
                          class="sponsor-img img-fluid" 
                          alt="{{ sponsor.name }}"
                          title="{{ sponsor.name }}"
@@ -641,7 +3226,7 @@ def home():
                       {% for sponsor in sponsors[i:i+3] %}
                         <div class="col-md-4 text-center">
                           <a href="{{ sponsor.url }}" target="_blank">
-                            <img src="{{ url_for('static', filename='img/sponsors/' + sponsor.image) }}" 
+                            <img src="{{ sponsor.image_url }}" 
                                  class="sponsor-img img-fluid" 
                                  alt="{{ sponsor.name }}"
                                  title="{{ sponsor.name }}">
@@ -669,44 +3254,87 @@ def home():
         {% endif %}
       </div>
       <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
+      <script>
+        (function () {
+          var input = document.querySelector('input[list="suggestions"]'), list = document.getElementById('suggestions'), timer;
+          input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(function () {
+              if (input.value.trim().length < 2) { return; }
+              fetch('{{ url_for("suggest") }}?q=' + encodeURIComponent(input.value))
+                .then(function (r) { return r.json(); })
+                .then(function (data) {
+                  list.innerHTML = '';
+                  data.suggestions.forEach(function (s) {
+                    var option = document.createElement('option');
+                    option.value = s.text;
+                    list.appendChild(option);
+                  });
+                });
+            }, 150);
+          });
+        })();
+      </script>
       <script src="https://kit.fontawesome.com/your-fontawesome-kit.js"></script>
     </body>
     </html>
     '''
 
-    return render_template_string(
+    return (stream_page if isinstance(results, ListingStream) else render_page)(
+        'home.html',
         home_template,
         provinces=PROVINCES,
         results=results,
         user=user,
         bg_url=bg_url,
         sponsors=sponsors,
+        province_counts=province_counts(),
         nav_html=default_nav(user),
-        sort_by=sort_by
+        sort_by=sort_by,
+        fuzzy=fuzzy,
+        **listing_page_links(results, next_cursor, fuzzy)
     )
 
 
+def home_validator():
+    # The home page also shows the sponsors
+    version, last_modified = facet_validator()
+    return f'{version}:sponsors:{sponsors_version()}', last_modified
+
+
+def listing_validator(listing_id):
+    """Listings are never edited in place, so id and creation time identify the page's content
+    once its photos have been processed"""
+    row = db.session.query(Listing.created_at).filter(Listing.id == listing_id).first()
+    if row is None or row.created_at is None:
+        return None
+    if ListingPhoto.query.filter_by(listing_id=listing_id, ready=False).first() is not None:
+        return None
+    return f'listing:{listing_id}:{row.created_at.isoformat()}', row.created_at
+
+
+def count_listing_view(listing_id):
+    # The reload once the photos are processed (?refreshed=1) belongs to a view already counted
+    if not request.args.get('refreshed'):
+        record_view(listing_id)
+
+
 # Individual listing page with view counting
 @app.route('/listing/<int:listing_id>')
+@conditional_page(listing_validator, not_modified=count_listing_view)
 def listing_detail(listing_id):
-    listing = Listing.query.get_or_404(listing_id)
+    listing = Listing.query.options(joinedload(Listing.seller_user)).get_or_404(listing_id)
 
-    # Increment view count
-    listing.view_count = Listing.view_count + 1
-    db.session.commit()
+    # Count the view in the buffer; it reaches the database on the next flush
+    count_listing_view(listing.id)
+    view_count = (listing.view_count or 0) + pending_views(listing.id)
 
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
 
-    # Handle both old single photo and new multiple photos
-    photos = []
-    if listing.photos:
-        photos = listing.photos.split(',')
-    # Fallback for old listings that might still use the single photo field
-    elif hasattr(listing, 'photo') and listing.photo:
-        photos = [listing.photo]
+    photos = listing_photo_refs(listing)
 
-    return render_template_string('''
+    return render_page('listing_detail.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -746,7 +3374,7 @@ def listing_detail(listing_id):
             <div class="carousel-inner">
               {% for photo in photos %}
               <div class="carousel-item {% if loop.first %}active{% endif %}">
-                <img src="{{ url_for('static', filename='uploads/' + photo) }}" class="d-block w-100 carousel-image" alt="Listing photo {{ loop.index }}">
+                {{ photo_picture(photo, 'detail', class_='d-block w-100 carousel-image', alt='Listing photo ' ~ loop.index, loading='eager' if loop.first else 'lazy') }}
               </div>
               {% endfor %}
             </div>
@@ -765,7 +3393,7 @@ def listing_detail(listing_id):
               <div>
                 <h2 class="card-title">{{ listing.title }}</h2>
                 <div class="view-count">
-                  <i class="fas fa-eye"></i> {{ listing.view_count }} views • Posted {{ listing.created_at.strftime('%B %d, %Y') }}
+                  <i class="fas fa-eye"></i> {{ view_count }} views • Posted {{ listing.created_at.strftime('%B %d, %Y') }}
                 </div>
               </div>
               {% if user and user.id == listing.user_id %}
@@ -799,9 +3427,37 @@ def listing_detail(listing_id):
       </div>
       <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
       <script src="https://kit.fontawesome.com/your-fontawesome-kit.js"></script>
+      {% if photos_pending %}
+      <script>
+        (function () {
+          var polls = 0;
+          var timer = setInterval(function () {
+            if (++polls > {{ poll_limit }}) { clearInterval(timer); return; }
+            fetch('{{ url_for('listing_photo_status', listing_id=listing.id) }}')
+              .then(function (response) { return response.json(); })
+              .then(function (status) {
+                if (!status.pending) {
+                  clearInterval(timer);
+                  location.replace('{{ url_for('listing_detail', listing_id=listing.id, refreshed=1) }}');
+                }
+              });
+          }, {{ poll_interval * 1000 }});
+        })();
+      </script>
+      {% endif %}
     </body>
     </html>
-    ''', listing=listing, user=user, bg_url=bg_url, photos=photos, nav_html=default_nav(user))
+    ''', listing=listing, user=user, bg_url=bg_url, photos=photos, view_count=view_count,
+                                  photos_pending=not all(p.ready for p in photos),
+                                  poll_interval=PHOTO_POLL_INTERVAL, poll_limit=PHOTO_POLL_LIMIT,
+                                  nav_html=default_nav(user))
+
+
+@app.route('/listing/<int:listing_id>/photos/status')
+def listing_photo_status(listing_id):
+    """Polled by a listing page whose photos are still being processed"""
+    pending = ListingPhoto.query.filter_by(listing_id=listing_id, ready=False).count()
+    return jsonify(pending=pending)
 
 
 # Delete listing
@@ -816,15 +3472,17 @@ def delete_listing(listing_id):
         flash("You don't have permission to delete this listing.", "danger")
         return redirect(url_for('listing_detail', listing_id=listing_id))
 
-    # Delete associated photos from filesystem
-    if listing.photos:
-        for photo in listing.photos.split(','):
-            photo_path = os.path.join('static/uploads', photo)
-            if os.path.exists(photo_path):
-                os.remove(photo_path)
+    # Photo files still used by other listings stay; the rest are removed once the delete is committed
+    unused_photos = release_listing_photos(listing)
 
+    unindex_listing_search(listing)
+    adjust_facet_counts(listing.province, listing.category, -1)
+    discard_views(listing.id)
     db.session.delete(listing)
     db.session.commit()
+    queue_photo_removal(unused_photos)
+    SUGGESTIONS.remove_listing(listing_id, listing.title)
+    invalidate_listing_pages(listing.province, listing.category)
 
     flash('Listing deleted successfully.', 'success')
     return redirect(url_for('home'))
@@ -832,36 +3490,35 @@ def delete_listing(listing_id):
 
 # All listings page (not limited to 6)
 @app.route('/all-listings')
+@conditional_page(lambda: facet_validator())
+@cached_page(tags=lambda: listing_tags())
 def all_listings():
     q = request.args.get('q', '').strip().lower()
     province_filter = request.args.get('province', '')
     sort_by = request.args.get('sort', 'newest')
 
+    fuzzy = False
+    total = None
     if q:
-        results = Listing.query.filter(
-            db.or_(
-                Listing.title.ilike(f'%{q}%'),
-                Listing.category.ilike(f'%{q}%'),
-                Listing.description.ilike(f'%{q}%')
-            )
-        )
-        if province_filter:
-            results = results.filter(Listing.province == province_filter)
+        SUGGESTIONS.record_query(q)
+        results, next_cursor, fuzzy = find_listings(q, province_filter, sort_by, page_size(), stream=STREAM_PAGES)
     else:
-        results = Listing.query
-
-    # Apply sorting
-    if sort_by == 'popular':
-        results = results.order_by(Listing.view_count.desc())
-    else:  # newest
-        results = results.order_by(Listing.created_at.desc())
-
-    results = results.all()
+        listings = filter_by_price(Listing.query, sort_by)
+        if province_filter:
+            listings = listings.filter(Listing.province == province_filter)
+        # The facet counts cover the province filter but not the price ones, the total is left out then
+        if not ({'min_price', 'max_price', 'currency'}.intersection(request.args) or sort_by in PRICE_SORTS):
+            total = total_listing_count(province_filter)
+        if STREAM_PAGES:
+            results, next_cursor = ListingStream(listings, sort_by, per_page=page_size()), None
+        else:
+            # Apply filters and sorting and fetch one page
+            results, next_cursor = paginate_listings(listings, sort_by, per_page=page_size())
 
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
 
-    return render_template_string('''
+    return (stream_page if STREAM_PAGES else render_page)('all_listings.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -898,10 +3555,11 @@ def all_listings():
 
         <!-- Search and Sort Form -->
         <form method="get" class="row g-3 mb-4 p-3 bg-dark rounded">
-          <div class="col-md-4">
-            <input class="form-control" name="q" placeholder="Search listings..." value="{{ request.args.get('q','') }}">
-          </div>
           <div class="col-md-3">
+            <input class="form-control" name="q" placeholder="Search listings..." value="{{ request.args.get('q','') }}" list="suggestions" autocomplete="off">
+            <datalist id="suggestions"></datalist>
+          </div>
+          <div class="col-md-2">
             <select name="province" class="form-select">
               <option value="">All Provinces</option>
               {% for p in provinces %}
@@ -909,13 +3567,22 @@ def all_listings():
               {% endfor %}
             </select>
           </div>
-          <div class="col-md-3">
+          <div class="col-6 col-md-2">
+            <input type="number" min="0" step="any" name="min_price" class="form-control" placeholder="Min price ($)" value="{{ request.args.get('min_price','') }}">
+          </div>
+          <div class="col-6 col-md-2">
+            <input type="number" min="0" step="any" name="max_price" class="form-control" placeholder="Max price ($)" value="{{ request.args.get('max_price','') }}">
+          </div>
+          <div class="col-md-2">
             <select name="sort" class="form-select">
               <option value="newest" {% if request.args.get('sort','newest')=='newest' %}selected{% endif %}>Newest First</option>
               <option value="popular" {% if request.args.get('sort','newest')=='popular' %}selected{% endif %}>Most Popular</option>
+              <option value="relevance" {% if request.args.get('sort','newest')=='relevance' %}selected{% endif %}>Best Match</option>
+              <option value="price_asc" {% if request.args.get('sort','newest')=='price_asc' %}selected{% endif %}>Price: Low to High</option>
+              <option value="price_desc" {% if request.args.get('sort','newest')=='price_desc' %}selected{% endif %}>Price: High to Low</option>
             </select>
           </div>
-          <div class="col-md-2">
+          <div class="col-md-1">
             <button class="btn btn-danger w-100">Filter</button>
           </div>
         </form>
@@ -923,13 +3590,15 @@ def all_listings():
         <div class="d-flex justify-content-between align-items-center mb-3">
           <h5 class="text-light">
             {% if q %}
-              Search results for "{{ q }}" ({{ results|length }} listings)
+              Search results for "{{ q }}"
+              {% if fuzzy %}<small class="text-white-50 d-block mt-1">No exact matches, showing close matches</small>{% endif %}
             {% else %}
-              All Listings ({{ results|length }} total)
+              {% if province_filter %}Listings in {{ province_filter }}{% else %}All Listings{% endif %}
+              {% if total is not none %}({{ total }} total){% endif %}
             {% endif %}
           </h5>
           <div class="text-light">
-            Sorted by: <strong>{% if sort_by == 'newest' %}Newest{% else %}Most Popular{% endif %}</strong>
+            Sorted by: <strong>{% if sort_by == 'popular' %}Most Popular{% elif sort_by == 'price_asc' %}Lowest Price{% elif sort_by == 'price_desc' %}Highest Price{% elif (sort_by == 'relevance' or fuzzy) and q %}Best Match{% else %}Newest{% endif %}</strong>
           </div>
         </div>
 
@@ -938,12 +3607,8 @@ def all_listings():
           {% for r in results %}
             <div class="col-12 col-md-6 col-lg-4">
               <div class="card shadow-sm h-100 listing-card" onclick="window.location=\'{{ url_for("listing_detail", listing_id=r.id) }}\'">
-                {% if r.photos %}
-                  {% set photo_list = r.photos.split(',') %}
-                  {% set first_photo = photo_list[0] %}
-                  <img src="{{ url_for('static', filename='uploads/' + first_photo) }}" class="card-img-top" alt="photo" style="height: 200px; object-fit: cover;">
-                {% elif r.photo %}
-                  <img src="{{ url_for('static', filename='uploads/' + r.photo) }}" class="card-img-top" alt="photo" style="height: 200px; object-fit: cover;">
+                {% if covers.get(r.id) %}
+                  {{ photo_picture(covers[r.id], 'card', class_='card-img-top', alt='photo', style='height: 200px; object-fit: cover;') }}
                 {% endif %}
                 <div class="card-body">
                   <h5 class="mb-1">{{ r.title }}</h5>
@@ -971,6 +3636,12 @@ def all_listings():
             </div>
           {% endfor %}
           </div>
+          {% if next_url or first_url %}
+            <div class="d-flex justify-content-center gap-2 mt-4">
+              {% if first_url %}<a href="{{ first_url }}" class="btn btn-outline-light">« First page</a>{% endif %}
+              {% if next_url %}<a href="{{ next_url }}" class="btn btn-danger">Next page »</a>{% endif %}
+            </div>
+          {% endif %}
         {% else %}
           <div class="text-center text-muted py-5">
             <h4>No listings found</h4>
@@ -979,23 +3650,66 @@ def all_listings():
         {% endif %}
       </div>
       <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
+      <script>
+        (function () {
+          var input = document.querySelector('input[list="suggestions"]'), list = document.getElementById('suggestions'), timer;
+          input.addEventListener('input', function () {
+            clearTimeout(timer);
+            timer = setTimeout(function () {
+              if (input.value.trim().length < 2) { return; }
+              fetch('{{ url_for("suggest") }}?q=' + encodeURIComponent(input.value))
+                .then(function (r) { return r.json(); })
+                .then(function (data) {
+                  list.innerHTML = '';
+                  data.suggestions.forEach(function (s) {
+                    var option = document.createElement('option');
+                    option.value = s.text;
+                    list.appendChild(option);
+                  });
+                });
+            }, 150);
+          });
+        })();
+      </script>
       <script src="https://kit.fontawesome.com/your-fontawesome-kit.js"></script>
     </body>
     </html>
     ''', provinces=PROVINCES, results=results, user=user, bg_url=bg_url, nav_html=default_nav(user), q=q,
-                                  sort_by=sort_by)
+        sort_by=sort_by, province_filter=province_filter, total=total, fuzzy=fuzzy, **listing_page_links(results, next_cursor, fuzzy))
+
+
+# Search-as-you-type suggestions, answered from memory without touching the database
+@app.route('/suggest')
+def suggest():
+    ensure_suggestions()
+    q = request.args.get('q', '')
+    suggestions = SUGGESTIONS.lookup(q[:100])
+    for s in suggestions:
+        if s['kind'] == 'listing':
+            s['url'] = url_for('listing_detail', listing_id=s['ref'])
+        elif s['kind'] == 'province':
+            s['url'] = url_for('province_page', province=s['ref'])
+        else:
+            s['url'] = url_for('home', q=s['text'])
+        del s['ref']
+    return jsonify(q=q, suggestions=suggestions)
 
 
 # Province page
 @app.route('/province/<province>')
+@conditional_page(lambda province: facet_validator(province))
+@cached_page(tags=lambda province: {f'province:{province}'})
 def province_page(province):
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
-    province_listings = Listing.query.filter_by(province=province).order_by(Listing.created_at.desc()).all()
-    prov_cats = db.session.query(Listing.category).filter_by(province=province).distinct().all()
-    prov_cats = [cat[0] for cat in prov_cats] if prov_cats else CATEGORIES
+    sort_by = request.args.get('sort', 'newest')
+    # Cards show the seller name, so load sellers in the same query instead of one SELECT per card
+    province_listings, next_cursor = paginate_listings(
+        filter_by_price(Listing.query.options(joinedload(Listing.seller_user)).filter_by(province=province), sort_by),
+        sort_by, per_page=page_size(12))
+    prov_cats = province_category_counts(province) or [(cat, 0) for cat in CATEGORIES]
 
-    return render_template_string('''
+    return render_page('province_page.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1030,11 +3744,11 @@ def province_page(province):
         </div>
         <p class="lead">Pick a category</p>
         <div class="row g-3 justify-content-start mb-4">
-          {% for cat in prov_cats %}
+          {% for cat, count in prov_cats %}
             <div class="col-6 col-md-3">
               <div class="card shadow-sm h-100">
                 <div class="card-body d-flex flex-column">
-                  <h5 class="fw-bold text-danger">{{ cat }}</h5>
+                  <h5 class="fw-bold text-danger">{{ cat }} <span class="badge text-bg-secondary">{{ count }}</span></h5>
                   <p class="small text-muted">Browse {{ cat }} in {{ province }}</p>
                   <a class="btn btn-outline-danger btn-sm mt-auto" href="{{ url_for('category_page', province=province, category=cat) }}">View</a>
                 </div>
@@ -1044,14 +3758,25 @@ def province_page(province):
         </div>
         <hr>
         <h4 class="mb-3">Featured in {{ province }}</h4>
+        <form method="get" class="row g-2 align-items-center mb-3">
+          <div class="col-6 col-md-3"><input type="number" min="0" step="any" name="min_price" class="form-control form-control-sm" placeholder="Min price ($)" value="{{ request.args.get('min_price','') }}"></div>
+          <div class="col-6 col-md-3"><input type="number" min="0" step="any" name="max_price" class="form-control form-control-sm" placeholder="Max price ($)" value="{{ request.args.get('max_price','') }}"></div>
+          <div class="col-8 col-md-4">
+            <select name="sort" class="form-select form-select-sm">
+              {% for value, label in [('newest', 'Newest First'), ('popular', 'Most Popular'), ('price_asc', 'Price: Low to High'), ('price_desc', 'Price: High to Low')] %}
+                <option value="{{ value }}" {% if value == sort_by %}selected{% endif %}>{{ label }}</option>
+              {% endfor %}
+            </select>
+          </div>
+          <div class="col-4 col-md-2"><button class="btn btn-danger btn-sm w-100">Apply</button></div>
+        </form>
         {% if province_listings %}
           <div class="row g-3">
-            {% for item in province_listings[:12] %}
+            {% for item in province_listings %}
               <div class="col-12 col-md-6 col-lg-4">
                 <div class="card shadow-sm h-100 listing-card" onclick="window.location='{{ url_for('listing_detail', listing_id=item.id) }}'">
-                  {% if item.photos %}
-                    {% set first_photo = item.photos.split(',')[0] %}
-                    <img src="{{ url_for('static', filename='uploads/' + first_photo) }}" class="card-img-top" alt="photo" style="height: 200px; object-fit: cover;">
+                  {% if covers.get(item.id) %}
+                    {{ photo_picture(covers[item.id], 'card', class_='card-img-top', alt='photo', style='height: 200px; object-fit: cover;') }}
                   {% endif %}
                   <div class="card-body">
                     <span class="badge text-bg-danger float-end">{{ item.category }}</span>
@@ -1077,6 +3802,12 @@ def province_page(province):
               </div>
             {% endfor %}
           </div>
+          {% if next_url or first_url %}
+            <div class="d-flex justify-content-center gap-2 mt-4">
+              {% if first_url %}<a href="{{ first_url }}" class="btn btn-outline-secondary">« First page</a>{% endif %}
+              {% if next_url %}<a href="{{ next_url }}" class="btn btn-danger">Next page »</a>{% endif %}
+            </div>
+          {% endif %}
         {% else %}
           <p class="text-muted">No listings yet in {{ province }}.</p>
         {% endif %}
@@ -1086,17 +3817,26 @@ def province_page(province):
       <script src="https://kit.fontawesome.com/your-fontawesome-kit.js"></script>
     </body>
     </html>
-    ''', province=province, prov_cats=prov_cats, province_listings=province_listings, user=user, bg_url=bg_url,
-                                  nav_html=default_nav(user))
+    ''', province=province, prov_cats=prov_cats, province_listings=province_listings,
+                                  covers=cover_photos(province_listings), user=user, bg_url=bg_url,
+                                  nav_html=default_nav(user), sort_by=sort_by,
+                                  next_url=page_url(next_cursor) if next_cursor else None,
+                                  first_url=page_url(None) if request.args.get('cursor') else None)
 
 
 # Category page
 @app.route('/province/<province>/<path:category>', endpoint='category_page')
+@conditional_page(lambda province, category: facet_validator(province, category))
+@cached_page(tags=lambda province, category: {f'category:{province}/{category}'})
 def category_page(province, category):
-    matches = Listing.query.filter_by(province=province, category=category).order_by(Listing.created_at.desc()).all()
+    sort_by = request.args.get('sort', 'newest')
+    matches, next_cursor = paginate_listings(
+        filter_by_price(Listing.query.options(joinedload(Listing.seller_user))
+                        .filter_by(province=province, category=category), sort_by),
+        sort_by, per_page=page_size())
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
-    return render_template_string('''
+    return render_page('category_page.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1129,14 +3869,25 @@ def category_page(province, category):
           <h3 class="text-danger fw-bold">{{ category }} — {{ province }}</h3>
           {% if user %}<a href="{{ url_for('post_listing', province=province, category=category) }}" class="btn btn-danger">Post {{ category }}</a>{% endif %}
         </div>
+        <form method="get" class="row g-2 align-items-center mb-3">
+          <div class="col-6 col-md-3"><input type="number" min="0" step="any" name="min_price" class="form-control form-control-sm" placeholder="Min price ($)" value="{{ request.args.get('min_price','') }}"></div>
+          <div class="col-6 col-md-3"><input type="number" min="0" step="any" name="max_price" class="form-control form-control-sm" placeholder="Max price ($)" value="{{ request.args.get('max_price','') }}"></div>
+          <div class="col-8 col-md-4">
+            <select name="sort" class="form-select form-select-sm">
+              {% for value, label in [('newest', 'Newest First'), ('popular', 'Most Popular'), ('price_asc', 'Price: Low to High'), ('price_desc', 'Price: High to Low')] %}
+                <option value="{{ value }}" {% if value == sort_by %}selected{% endif %}>{{ label }}</option>
+              {% endfor %}
+            </select>
+          </div>
+          <div class="col-4 col-md-2"><button class="btn btn-danger btn-sm w-100">Apply</button></div>
+        </form>
         {% if matches %}
           <div class="row g-3">
             {% for item in matches %}
               <div class="col-12 col-md-6 col-lg-4">
                 <div class="card shadow-sm h-100 listing-card" onclick="window.location='{{ url_for('listing_detail', listing_id=item.id) }}'">
-                  {% if item.photos %}
-                    {% set first_photo = item.photos.split(',')[0] %}
-                    <img src="{{ url_for('static', filename='uploads/' + first_photo) }}" class="card-img-top" alt="photo" style="height: 200px; object-fit: cover;">
+                  {% if covers.get(item.id) %}
+                    {{ photo_picture(covers[item.id], 'card', class_='card-img-top', alt='photo', style='height: 200px; object-fit: cover;') }}
                   {% endif %}
                   <div class="card-body">
                     <h5 class="mb-1">{{ item.title }}</h5>
@@ -1161,6 +3912,12 @@ def category_page(province, category):
               </div>
             {% endfor %}
           </div>
+          {% if next_url or first_url %}
+            <div class="d-flex justify-content-center gap-2 mt-4">
+              {% if first_url %}<a href="{{ first_url }}" class="btn btn-outline-secondary">« First page</a>{% endif %}
+              {% if next_url %}<a href="{{ next_url }}" class="btn btn-danger">Next page »</a>{% endif %}
+            </div>
+          {% endif %}
         {% else %}
           <p class="text-muted text-center">No listings yet in this category for {{ province }}.</p>
         {% endif %}
@@ -1173,7 +3930,11 @@ def category_page(province, category):
       <script src="https://kit.fontawesome.com/your-fontawesome-kit.js"></script>
     </body>
     </html>
-    ''', province=province, category=category, matches=matches, user=user, bg_url=bg_url, nav_html=default_nav(user))
+    ''', province=province, category=category, matches=matches, covers=cover_photos(matches), user=user,
+                                  bg_url=bg_url, nav_html=default_nav(user),
+                                  sort_by=sort_by,
+                                  next_url=page_url(next_cursor) if next_cursor else None,
+                                  first_url=page_url(None) if request.args.get('cursor') else None)
 
 
 # Post listing route with multiple photos and country codes
@@ -1198,49 +3959,47 @@ def post_listing(province=None, category=None):
         country_code_phone = request.form.get('country_code_phone', '+263')
         country_code_whatsapp = request.form.get('country_code_whatsapp', '+263')
 
-        photo_files = request.files.getlist('photos')
-        filenames = []
-
-        # Handle multiple photo uploads (up to 10)
-        for i, photo_file in enumerate(photo_files[:10]):
-            if photo_file and photo_file.filename:
-                ext = os.path.splitext(photo_file.filename)[1].lower()
-                if ext in ALLOWED_EXT:
-                    safe = secure_filename(photo_file.filename)
-                    filename = f"{int(time.time())}_{i}_{safe}"
-                    photo_file.save(os.path.join('static/uploads', filename))
-                    filenames.append(filename)
-                else:
-                    flash(f'Unsupported image type for file {i + 1}.', 'danger')
-                    return redirect(request.url)
-
         if not title or not sel_province or not sel_category:
             flash('Title, province and category are required.', 'danger')
             return redirect(request.url)
 
+        # The photos were checked and staged while the form was parsed; the photo pool does the image work
+        filenames = [photo_file.stream.claim() for photo_file in request.files.getlist('photos')
+                     if isinstance(photo_file.stream, StagedUpload)]
+
         # Create new listing in database
+        price_amount, price_currency = parse_price(price)
         new_listing = Listing(
             title=title,
             category=sel_category,
             province=sel_province,
             price=price,
+            price_amount=price_amount,
+            price_currency=price_currency,
             description=description,
             phone=phone,
             whatsapp=whatsapp,
             email=email,
-            photos=','.join(filenames) if filenames else None,
             country_code_phone=country_code_phone,
             country_code_whatsapp=country_code_whatsapp,
             user_id=user.id
         )
 
+        stage_listing_photos(new_listing, filenames)
         db.session.add(new_listing)
+        db.session.flush()
+        index_listing_search(new_listing)
+        adjust_facet_counts(new_listing.province, new_listing.category, 1)
         db.session.commit()
+        if filenames:
+            queue_listing_photos(new_listing.id)
+        SUGGESTIONS.add_listing(new_listing.id, new_listing.title)
+        invalidate_listing_pages(new_listing.province, new_listing.category)
 
         flash('Listing posted successfully!', 'success')
         return redirect(url_for('listing_detail', listing_id=new_listing.id))
 
-    return render_template_string('''
+    return render_page('post_listing.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1388,7 +4147,7 @@ def register():
         return redirect(url_for('login'))
 
     bg_url = url_for('static', filename='img/site-bg.jpg')
-    return render_template_string('''
+    return render_page('register.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1441,7 +4200,7 @@ def login():
         flash('Invalid email or password.', 'danger')
 
     bg_url = url_for('static', filename='img/site-bg.jpg')
-    return render_template_string('''
+    return render_page('login.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1486,10 +4245,11 @@ def logout():
 
 # Investment routes
 @app.route('/invest')
+@cached_page()
 def invest():
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
-    return render_template_string('''
+    return render_page('invest.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1533,6 +4293,7 @@ def invest():
 
 
 @app.route('/invest/<path:sector>')
+@cached_page()
 def invest_sector(sector):
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
@@ -1543,7 +4304,7 @@ def invest_sector(sector):
         "Incentives and tax considerations",
         "Starter checklist"
     ]
-    return render_template_string('''
+    return render_page('invest_sector.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1579,10 +4340,11 @@ def invest_sector(sector):
 
 # Markets routes
 @app.route('/markets')
+@cached_page()
 def markets():
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
-    return render_template_string('''
+    return render_page('markets.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1629,12 +4391,14 @@ def markets():
 
 
 @app.route('/markets/currencies')
+@cached_page(tags=lambda: {'markets:currencies'})
 def markets_currencies():
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
     rates = get_live_currencies()
-    last_updated = datetime.fromtimestamp(CACHE["currencies"]["ts"]).strftime("%Y-%m-%d %H:%M")
-    return render_template_string('''
+    age = market_data_age('currencies')
+    last_updated = datetime.fromtimestamp(CACHE["currencies"]["ts"]).strftime("%Y-%m-%d %H:%M") if age is not None else None
+    return render_page('markets_currencies.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1658,7 +4422,7 @@ def markets_currencies():
       <div class="container py-4">
         <div class="d-flex justify-content-between align-items-center mb-3">
           <h2 class="text-danger fw-bold mb-0">Exchange Rates</h2>
-          <div><span class="badge bg-secondary me-2">Last updated {{ last_updated }}</span>
+          <div><span class="badge bg-secondary me-2">{% if last_updated %}Last updated {{ last_updated }} ({{ (age // 60)|int }} min ago){% else %}Updating…{% endif %}</span>
             <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('markets_currencies') }}">Refresh</a></div>
         </div>
         <table class="table table-striped table-bordered bg-white">
@@ -1671,16 +4435,18 @@ def markets_currencies():
       <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
     </body>
     </html>
-    ''', user=user, bg_url=bg_url, rates=rates, last_updated=last_updated, nav_html=default_nav(user))
+    ''', user=user, bg_url=bg_url, rates=rates, last_updated=last_updated, age=age, nav_html=default_nav(user))
 
 
 @app.route('/markets/metals')
+@cached_page(tags=lambda: {'markets:metals'})
 def markets_metals():
     user = current_user()
     bg_url = url_for('static', filename='img/site-bg.jpg')
     metals = get_live_metals()
-    last_updated = datetime.fromtimestamp(CACHE["metals"]["ts"]).strftime("%Y-%m-%d %H:%M")
-    return render_template_string('''
+    age = market_data_age('metals')
+    last_updated = datetime.fromtimestamp(CACHE["metals"]["ts"]).strftime("%Y-%m-%d %H:%M") if age is not None else None
+    return render_page('markets_metals.html', '''
     <!doctype html>
     <html lang="en">
     <head>
@@ -1704,7 +4470,7 @@ def markets_metals():
       <div class="container py-4">
         <div class="d-flex justify-content-between align-items-center mb-3">
           <h2 class="text-danger fw-bold mb-0">Metals Prices</h2>
-          <div><span class="badge bg-secondary me-2">Last updated {{ last_updated }}</span>
+          <div><span class="badge bg-secondary me-2">{% if last_updated %}Last updated {{ last_updated }} ({{ (age // 60)|int }} min ago){% else %}Updating…{% endif %}</span>
             <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('markets_metals') }}">Refresh</a></div>
         </div>
         <table class="table table-striped table-bordered bg-white">
@@ -1717,7 +4483,7 @@ def markets_metals():
       <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/js/bootstrap.bundle.min.js"></script>
     </body>
     </html>
-    ''', user=user, bg_url=bg_url, metals=metals, last_updated=last_updated, nav_html=default_nav(user))
+    ''', user=user, bg_url=bg_url, metals=metals, last_updated=last_updated, age=age, nav_html=default_nav(user))
 
 
 